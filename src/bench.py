@@ -0,0 +1,212 @@
+# -*- encoding: utf-8 -*-
+# $File: bench.py
+#
+# Copyright (C) 2012 the pynojo development team <see AUTHORS file>
+#
+# This file is part of pynojo
+#
+# pynojo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynojo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynojo.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function, unicode_literals
+import sys, os, gc, time, timeit, socket, subprocess
+
+import protocol
+
+# Micro benchmarks for the protocol layer.
+#
+# Usage: python bench.py [rounds]
+#        python bench.py envelope [rounds]
+#        python bench.py readline [lines]
+#        python bench.py idle [connections]
+#
+
+def bench_json_backends(rounds):
+    '''Encode and parse a request and a response with every backend.'''
+    params = {'name': 'judger-%d' % 42, 'scores': list(range(0, 50)),
+              'detail': {'time': 0.125, 'memory': 65536, 'ok': True}}
+    req = protocol.Request('report', params, 1)
+    resp = protocol.Response(params, None, 1)
+
+    def run():
+        protocol.parseJson(req.toJSON())
+        protocol.parseJson(resp.toJSON())
+
+    selected = protocol.load_backend()
+    results = []
+    try:
+        for name, backend in protocol.JSON_BACKENDS:
+            try:
+                protocol.use_backend(name)
+            except ImportError:
+                print('%-12s not installed' % name)
+                continue
+            cost = min(timeit.repeat(run, number=rounds, repeat=3))
+            results.append((name, cost))
+    finally:
+        protocol.use_backend(selected)
+
+    slowest = max(cost for name, cost in results)
+    for name, cost in results:
+        print('%-12s %8.2f us/round-trip  %5.2fx'
+              % (name, cost * 1e6 / rounds, slowest / cost))
+    print('selected: %s' % selected)
+
+def bench_envelope(rounds):
+    '''
+    Split 4 MB messages into their envelopes, as the gateway does, and 
+    compare with decoding them.
+    '''
+    size = 4 << 20
+    messages = [
+        ('one string', ['x' * size]),
+        ('strings', ['judger-%06d' % i for i in range(0, size // 16)]),
+        ('escaped', ['a\\"b' * 8] * (size // 32)),
+        ('numbers', list(range(0, size // 8))),
+        ('objects', [{'time': 0.125, 'ok': True, 'name': 'judger'}] 
+                    * (size // 48)),
+    ]
+    protocol.load_backend()
+    print('backend: %s' % protocol.json_backend)
+    for name, params in messages:
+        msg = protocol.Request('report', params, 1).toJSON()
+        if (not isinstance(msg, bytes)):
+            msg = msg.encode('utf-8')
+        envelope = min(timeit.repeat(lambda: protocol.parseEnvelope(msg),
+                                     number=rounds, repeat=3)) / rounds
+        decode = min(timeit.repeat(lambda: protocol.json_decode(msg),
+                                   number=rounds, repeat=3)) / rounds
+        print('%-12s %8.2f ms envelope  %8.2f ms decode  %6.1fx'
+              % (name, envelope * 1e3, decode * 1e3, decode / envelope))
+
+class _FakeSocket(object):
+    '''Socket handing out the same data in chunks, as recv does.'''
+    def __init__(self, data, size):
+        self._chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        self._chunks.reverse()
+
+    def recv(self, size):
+        return self._chunks.pop() if self._chunks else b''
+
+    def getpeername(self):
+        return ('127.0.0.1', 0)
+
+    def close(self):
+        pass
+
+def bench_readline(lines):
+    '''
+    Split pipelined 64 byte frames into lines, as sessions read them, and 
+    compare with a file over a socket pair.
+    '''
+    import session
+    frame = b'{"id":1,"method":"echo","params":["' + b'x' * 25 + b'"]}\n'
+    data = frame * lines
+    sck = _FakeSocket(data, session.READ_SIZE)
+    s = session.Session(sck)
+    start = time.time()
+    while s.readline():
+        pass
+    elapsed = time.time() - start
+    a, b = socket.socketpair()
+    fp = b.makefile('rb')
+    start = time.time()
+    offset = 0
+    while offset < len(data):
+        chunk = data[offset:offset + session.READ_SIZE]
+        a.sendall(chunk)
+        offset += len(chunk)
+        for i in range(0, len(chunk) // len(frame)):
+            fp.readline()
+    stdlib = time.time() - start
+    a.close()
+    b.close()
+    print('%-12s %8.3f s for %d lines' % ('session', elapsed, lines))
+    print('%-12s %8.3f s for %d lines' % ('makefile', stdlib, lines))
+
+def _rss():
+    '''Resident memory of this process in bytes.'''
+    import resource
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * resource.getpagesize()
+    except EnvironmentError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def bench_idle_sessions(connections):
+    '''
+    Measure the memory of idle connections, with sessions kept in a 
+    greenlet each, and parked.
+    
+    Each case runs in a process of its own, so that memory freed by one 
+    does not hide the cost of the other.
+    '''
+    for idleTimeout in ('none', '0.2'):
+        subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                               'idle-server', str(connections), 
+                               idleTimeout])
+
+def _idle_server(connections, idleTimeout):
+    '''Serve idle connections made by a child process.'''
+    import gevent, server
+    idleTimeout = None if idleTimeout == 'none' else float(idleTimeout)
+    svr = server.Server(('127.0.0.1', 0))
+    svr.idleTimeout = idleTimeout
+    svr.start()
+    gevent.sleep(0.5)
+    gc.collect()
+    before = _rss()
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), 
+                              'idle-client', str(connections), 
+                              str(svr.server_port)], 
+                             stdin=subprocess.PIPE)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        gevent.sleep(0.1)
+        ready = len(svr._parked) if idleTimeout else len(svr.clients)
+        if (ready >= connections):
+            break
+    gevent.sleep(0.5)
+    gc.collect()
+    after = _rss()
+    print('%-10s %6d connections  %8.0f bytes/connection' 
+          % ('parked' if idleTimeout else 'greenlet', len(svr.clients), 
+             float(after - before) / connections))
+    child.stdin.close()
+    child.wait()
+    svr.stop()
+
+def _idle_client(connections, port):
+    '''Open connections and keep them until stdin is closed.'''
+    sockets = [socket.create_connection(('127.0.0.1', port)) 
+               for i in range(0, connections)]
+    sys.stdin.read()
+    for s in sockets:
+        s.close()
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1 and sys.argv[1] == 'idle'):
+        bench_idle_sessions(int(sys.argv[2]) if len(sys.argv) > 2 
+                                             else 2000)
+    elif (len(sys.argv) > 1 and sys.argv[1] == 'envelope'):
+        bench_envelope(int(sys.argv[2]) if len(sys.argv) > 2 else 5)
+    elif (len(sys.argv) > 1 and sys.argv[1] == 'readline'):
+        bench_readline(int(sys.argv[2]) if len(sys.argv) > 2 else 200000)
+    elif (len(sys.argv) > 1 and sys.argv[1] == 'idle-server'):
+        _idle_server(int(sys.argv[2]), sys.argv[3])
+    elif (len(sys.argv) > 1 and sys.argv[1] == 'idle-client'):
+        _idle_client(int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+        bench_json_backends(rounds)
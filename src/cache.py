@@ -0,0 +1,117 @@
+# -*- encoding: utf-8 -*-
+# $File: cache.py
+#
+# Copyright (C) 2012 the pynojo development team <see AUTHORS file>
+#
+# This file is part of pynojo
+#
+# pynojo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynojo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynojo.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function, unicode_literals
+import time, copy
+from collections import OrderedDict
+
+import protocol
+
+# Result cache
+#
+# The server marks a result as cacheable by returning protocol.Cacheable
+# from the RPC method. The response then carries a "cache" member with
+# the version tag and time to live of the result, and the client keeps
+# the result until it expires, is pushed out by newer entries, or the
+# server calls cache_invalidate on the client.
+#
+# Results are copied into the cache and out of it again, so callers may
+# change the results they get without changing the cached ones.
+#
+
+class ResultCache(object):
+    '''LRU cache of RPC results, keyed by method and params.'''
+    def __init__(self, maxSize=1024, ttl=60):
+        '''
+        Create a result cache.
+
+        :param maxSize: Maximum number of entries.
+        :type maxSize: int.
+
+        :param ttl: Maximum seconds to keep an entry. The server may ask
+            for a shorter time. None to keep until invalidated.
+        :type ttl: float.
+        '''
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()   # key -> (result, version, expire)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(method, params):
+        '''Make the cache key of a call, or None if it has no key.'''
+        if (isinstance(params, dict)):
+            params = sorted(params.items())
+        try:
+            return (method, protocol.json_encode(params))
+        except protocol.JsonEncodeError:
+            return None
+
+    def get(self, key):
+        '''
+        Look up a call.
+
+        :return: Tuple (hit, result). The result is a copy of the 
+            cached one.
+        '''
+        entry = self._entries.pop(key, None)
+        if (entry is None or
+                entry[2] is not None and entry[2] < time.time()):
+            self.misses += 1
+            return (False, None)
+        self._entries[key] = entry      # most recently used
+        self.hits += 1
+        return (True, copy.deepcopy(entry[0]))
+
+    def put(self, key, result, version=None, ttl=None):
+        '''Store the result of a call.'''
+        if (ttl is None or self.ttl is not None and self.ttl < ttl):
+            ttl = self.ttl
+        self._entries.pop(key, None)
+        self._entries[key] = (copy.deepcopy(result), version,
+                              time.time() + ttl if ttl is not None
+                                                else None)
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, method, params=None, version=None):
+        '''
+        Drop entries of the method.
+
+        :param params: Drop only the entry of these params. None for all.
+        :param version: Keep entries having this version already.
+        '''
+        if (params is not None):
+            keys = [self.key(method, params)]
+        else:
+            keys = [k for k in self._entries if k[0] == method]
+        for k in keys:
+            entry = self._entries.get(k, None)
+            if (entry is not None and
+                    (version is None or entry[1] != version)):
+                del self._entries[k]
+
+    def clear(self):
+        '''Drop all entries.'''
+        self._entries.clear()
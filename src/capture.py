@@ -0,0 +1,137 @@
+# -*- encoding: utf-8 -*-
+# $File: capture.py
+#
+# Copyright (C) 2012 the pynojo development team <see AUTHORS file>
+#
+# This file is part of pynojo
+#
+# pynojo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynojo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynojo.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function, unicode_literals
+import os, time
+import gevent
+
+# Traffic capture
+#
+# A session with a recorder writes every message it reads or sends to a
+# capture file, one line each:
+#
+#     <time> <direction> <connection> <message>
+#
+# where direction is "i" for messages read and "o" for messages sent,
+# and connection is the name of the session (address:port). Messages
+# are recorded as JSON text, after shared memory segments are mapped.
+# Lines are buffered, and flushed by a timer flushInterval seconds after
+# the first of them is written, so at most that much traffic may be lost
+# if the process dies. When the file grows over maxBytes, it is renamed
+# to <path>.1 (older ones shift to <path>.2 and so on) and a new one is
+# started. See replay.py for driving a server with a capture.
+#
+
+class Recorder(object):
+    '''Append messages of sessions to a capture file.'''
+    def __init__(self, path, maxBytes=64 << 20, backups=3,
+                 flushInterval=1.0):
+        '''
+        Create a recorder.
+
+        :param path: Capture file. Appended to if it exists.
+        :param maxBytes: Size to rotate the file at. None to never rotate.
+        :param backups: Rotated files to keep.
+        :param flushInterval: Seconds to buffer lines for at most.
+        '''
+        self.path = path
+        self.maxBytes = maxBytes
+        self.backups = backups
+        self.flushInterval = flushInterval
+        self._flusher = None
+        self._open()
+
+    def _open(self):
+        self._fp = open(self.path, 'ab', 1 << 16)
+        self._size = self._fp.tell()
+
+    def record(self, session, direction, msg):
+        '''
+        Record a message.
+
+        :param direction: "i" for read, "o" for sent.
+        :param msg: Message without the line break.
+        '''
+        if (self._fp is None):
+            return      # closed
+        if (not isinstance(msg, bytes)):
+            msg = msg.encode('utf-8')
+        line = ('%.6f %s %s ' % (time.time(), direction, session.name)
+               ).encode('utf-8') + msg + b'\n'
+        self._fp.write(line)
+        self._size += len(line)
+        if (self.maxBytes is not None and self._size >= self.maxBytes):
+            self.rotate()
+        elif (self._flusher is None):
+            self._flusher = gevent.spawn_later(self.flushInterval, 
+                                               self.flush)
+
+    def rotate(self):
+        '''Start a new capture file, keeping the current one as .1.'''
+        self._fp.close()
+        for i in range(self.backups, 0, -1):
+            src = self.path if i == 1 else '%s.%d' % (self.path, i - 1)
+            if (os.path.exists(src)):
+                os.rename(src, '%s.%d' % (self.path, i))
+        if (self.backups == 0):
+            os.remove(self.path)
+        self._open()
+
+    def flush(self):
+        if (self._flusher is not None):
+            if (self._flusher is not gevent.getcurrent()):
+                self._flusher.kill(block=False)
+            self._flusher = None
+        if (self._fp is not None):
+            self._fp.flush()
+
+    def close(self):
+        self.flush()
+        if (self._fp is not None):
+            self._fp.close()
+            self._fp = None
+
+def capture_files(path):
+    '''Get the capture file and its rotated ones, oldest first.'''
+    ret = []
+    i = 1
+    while os.path.exists('%s.%d' % (path, i)):
+        ret.insert(0, '%s.%d' % (path, i))
+        i += 1
+    if (os.path.exists(path)):
+        ret.append(path)
+    return ret
+
+def read_capture(paths):
+    '''
+    Read capture files.
+
+    :param paths: Capture files, oldest first.
+    :return: Iterator of tuple (time, direction, connection, message).
+    '''
+    for path in paths:
+        with open(path, 'rb') as fp:
+            for line in fp:
+                parts = line.rstrip(b'\n').split(b' ', 3)
+                if (len(parts) < 4):
+                    continue    # cut short by a crash
+                yield (float(parts[0]), parts[1].decode('utf-8'),
+                       parts[2].decode('utf-8'), parts[3])
@@ -24,10 +24,10 @@
 #
 
 from __future__ import print_function, unicode_literals
-import session, protocol
+import session, protocol, cache, tls
 
-import socket
-import gevent.socket, gevent.ssl
+import socket, random
+import gevent, gevent.socket, gevent.ssl
 
 # Client Session
 class ClientSession(session.Session):
@@ -38,19 +38,42 @@ class ClientSession(session.Session):
     @protocol.expose
     def echo(self, message):
         return message
+        
+    @protocol.expose
+    def cache_invalidate(self, method, params=None, version=None):
+        '''Drop cached results of the method, pushed by the server.'''
+        if (self.cache is not None):
+            self.cache.invalidate(method, params, version)
 
 # Client 
 class Client(object):
     '''Implement the RPC client.'''
-    def __init__(self, address, sessionClass=ClientSession, **ssl_args):
+    def __init__(self, address, sessionClass=ClientSession, sslContext=None,
+                 serverHostname=None, **ssl_args):
         '''
         Create a client socket with remote server.
+        
+        :param sslContext: TLS configuration, see tls.client_context. 
+            The handshake runs in a thread, and the session is resumed 
+            when connecting to the same address again.
+        :type sslContext: ssl.SSLContext.
+        
+        :param serverHostname: Host name to check the certificate of the 
+            server against, if the context checks host names.
         '''
         self._sck = gevent.socket.create_connection(address)
-        if (len(ssl_args)):
+        if (sslContext is not None):
+            self._sck = tls.handshake(self._sck, sslContext, False, 
+                                      serverHostname, tuple(address), 
+                                      tls.clientStats)
+        elif (len(ssl_args)):
             self._sck = gevent.ssl.wrap_socket(self._sck, **ssl_args)
         self.SessionClass = sessionClass
         self.session = sessionClass(self._sck)
+        # Calls shed by a busy server are retried this many times, 
+        # waiting retryDelay seconds at first and doubling each time.
+        self.busyRetries = 3
+        self.retryDelay = 0.05
             
     def serve(self):
         '''Process client message loop.'''
@@ -75,13 +98,26 @@ class Client(object):
         
         Raise socket.error if the connection has been closed, and 
         gevent.timeout.Timeout when request timeout.
+        
+        If the server is busy, the call is retried with exponential 
+        backoff, and the Fault is raised if it is still busy at last.
         '''
-        if (self.session is None):
+        session = self.session
+        if (session is None):
             return
         try:
-            return self.session.call(method, *args, **kwargs)
+            delay = self.retryDelay
+            for i in range(0, self.busyRetries):
+                try:
+                    return session.call(method, *args, **kwargs)
+                except protocol.Fault as fault:
+                    if (fault.code != protocol.FAULT_SERVER_BUSY[0]):
+                        raise
+                gevent.sleep(delay * random.uniform(0.5, 1.5))
+                delay *= 2
+            return session.call(method, *args, **kwargs)
         except socket.error:
-            self.session.abandon()
+            session.abandon()
             self._sck = self.session = None
             raise
     
@@ -112,3 +148,28 @@ class Client(object):
         '''Get request timeout.'''
         return self.session.requestTimeout
         
+    def enableCache(self, maxSize=1024, ttl=60):
+        '''
+        Cache results marked as cacheable by the server. 
+        See cache.ResultCache for the arguments.
+        '''
+        self.session.cache = cache.ResultCache(maxSize, ttl)
+        
+    def setTracer(self, tracer):
+        '''
+        Trace calls with a tracing.Tracer. Calls made inside traced 
+        requests are traced anyway.
+        '''
+        self.session.tracer = tracer
+        
+    def setShmThreshold(self, threshold):
+        '''
+        Set the message size from which shared memory is used, if the 
+        server is on the same host. None to disable.
+        '''
+        self.session.shmThreshold = threshold
+        
+    def getShmThreshold(self):
+        '''Get shared memory threshold.'''
+        return self.session.shmThreshold
+        
@@ -0,0 +1,269 @@
+# -*- encoding: utf-8 -*-
+# $File: gateway.py
+#
+# Copyright (C) 2012 the pynojo development team <see AUTHORS file>
+#
+# This file is part of pynojo
+#
+# pynojo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynojo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynojo.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function, unicode_literals
+import logging, bisect, hashlib, socket
+import gevent, gevent.event, gevent.socket
+
+import protocol, session, server
+
+# The gateway accepts clients like a normal server, but instead of
+# dispatching their requests, it forwards them to pools of backend
+# servers. Only the envelope of each message is parsed (see
+# protocol.parseEnvelope), the id is rewritten, and everything else is
+# sent on as raw text. Responses travel back the same way.
+#
+# A batch is split into its messages, which are routed one by one, so
+# their responses come back one by one too. Backends can still call the
+# gateway, but it exposes no methods, to backends or to clients.
+#
+# Envelopes are byte strings, so are the member names and values.
+#
+
+# Error member sent to clients when their backend is lost.
+def _error(fault):
+    return ('{"code":%d,"message":"%s"}' % fault).encode('utf-8')
+
+_BACKEND_LOST = _error(protocol.FAULT_SERVER_ERROR)
+
+class HashRing(object):
+    '''Consistent hash ring over a list of nodes.'''
+    def __init__(self, nodes, replicas=64):
+        '''
+        Create a hash ring.
+
+        :param nodes: Nodes on the ring. Their str() should be unique.
+        :type nodes: list.
+
+        :param replicas: Virtual points of each node on the ring.
+        :type replicas: int.
+        '''
+        ring = []
+        for n in nodes:
+            for i in range(0, replicas):
+                ring.append((self._hash('%s#%d' % (n, i)), n))
+        ring.sort(key=lambda r: r[0])
+        self._keys = [r[0] for r in ring]
+        self._nodes = [r[1] for r in ring]
+
+    @staticmethod
+    def _hash(key):
+        if (not isinstance(key, bytes)):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def get(self, key):
+        '''Get the node for the key.'''
+        i = bisect.bisect(self._keys, self._hash(key))
+        return self._nodes[i % len(self._nodes)]
+
+class Route(object):
+    '''Send methods starting with the prefix to a pool of backends.'''
+    def __init__(self, prefix, backends):
+        '''
+        Create a route.
+
+        :param prefix: Method prefix. Empty string to match all.
+        :type prefix: unicode.
+
+        :param backends: Backend addresses.
+        :type backends: list of tuple (address, port).
+        '''
+        self.prefix = prefix
+        self.backends = [tuple(b) for b in backends]
+        self.ring = HashRing(['%s:%s' % b for b in self.backends])
+        self._addresses = dict(('%s:%s' % b, b) for b in self.backends)
+
+    def get(self, key):
+        '''Get the backend address for the routing key.'''
+        return self._addresses[self.ring.get(key)]
+
+# Session with a backend server
+class BackendSession(session.Session):
+    '''Gateway-side session with a backend server.'''
+    def __init__(self, gateway, socket):
+        super(BackendSession, self).__init__(socket)
+        self.gateway = gateway
+        self._forwards = {}     # backend id -> (client session, raw id)
+
+    def forward(self, client, members):
+        '''
+        Forward a request from a client.
+
+        :param members: Request members given by protocol.parseEnvelope.
+        '''
+        rawId = dict(members)[b'id']
+        if (rawId != b'null'):
+            rId = self._nextRquestId()
+            self._forwards[rId] = (client, rawId)
+            rawId = ('%d' % rId).encode('utf-8')
+        self.writeline(protocol.joinEnvelope(
+                [(b'id', rawId)] + [m for m in members if m[0] != b'id']))
+
+    def _got_message(self, msg):
+        '''Send responses back to the clients.'''
+        members = protocol.parseEnvelope(msg)
+        if (members is not None):
+            d = dict(members)
+            if (b'method' not in d and b'id' in d):
+                try:
+                    fwd = self._forwards.pop(int(d[b'id']), None)
+                except ValueError:
+                    fwd = None
+                if (fwd is not None):
+                    client, rawId = fwd
+                    client.writeline(protocol.joinEnvelope(
+                        [(b'id', rawId)] + [m for m in members
+                                            if m[0] != b'id']))
+                return
+        super(BackendSession, self)._got_message(msg)
+
+    def _disconnected(self):
+        '''Fail all forwarded requests.'''
+        super(BackendSession, self)._disconnected()
+        forwards = self._forwards
+        self._forwards = {}
+        for client, rawId in forwards.values():
+            client.writeline(protocol.joinEnvelope([(b'id', rawId),
+                                                    (b'error', _BACKEND_LOST)]))
+
+# Session with a client
+class GatewaySession(session.Session):
+    '''Gateway-side session with a client.'''
+    def __init__(self, server, socket):
+        super(GatewaySession, self).__init__(socket)
+        self.server = server
+
+    def _got_message(self, msg):
+        '''Route requests, and handle anything else as usual.'''
+        batch = protocol.splitBatch(msg)
+        if (not batch):
+            self._route(msg)
+            return
+        for m in batch:
+            self._route(m)
+
+    def _route(self, msg):
+        members = protocol.parseEnvelope(msg)
+        if (members is not None):
+            d = dict(members)
+            if (b'method' in d and b'id' in d):
+                self.server.route(self, members)
+                return
+        super(GatewaySession, self)._got_message(msg)
+
+    def _got_badmessage(self, msg):
+        '''On bad message received.'''
+        self.writeline(protocol.Response.encode(
+                          error=protocol.INVALID_JSON_RPC))
+
+# RPC gateway
+class Gateway(server.Server):
+    '''Implement the RPC gateway.'''
+
+    def __init__(self, listener, routes, sessionClass=GatewaySession,
+                 backlog=None, spawn='default', verbose=False, **ssl_args):
+        '''
+        Create a new RPC gateway.
+
+        :param listener: Tuple (address, port).
+        :type listener: tuple.
+        :param routes: Routes of methods. The longest matching prefix
+            wins.
+        :type routes: list of Route.
+        '''
+        server.Server.__init__(self, listener, sessionClass, backlog,
+                               spawn, verbose, **ssl_args)
+        self.routes = sorted(routes, key=lambda r: len(r.prefix),
+                             reverse=True)
+        self.backends = {}      # address -> BackendSession
+        self._connecting = {}   # address -> AsyncResult
+
+    def routeKey(self, method, members):
+        '''
+        Get the key to choose a backend in the pool.
+
+        Calls with the same method and params go to the same backend.
+        Derive this to shard on something else.
+        '''
+        return method.encode('utf-8') + dict(members).get(b'params', b'')
+
+    def route(self, client, members):
+        '''Forward a request from a client to its backend.'''
+        d = dict(members)
+        try:
+            method = protocol.json_decode(d[b'method'])
+            if (not isinstance(method, (type(''), str))):
+                method = None
+        except protocol.JsonDecodeError:
+            method = None
+        backend = None
+        for r in self.routes:
+            if (method is not None and method.startswith(r.prefix)):
+                backend = self._backend(r.get(self.routeKey(method,
+                                                            members)))
+                fault = protocol.SERVER_ERROR
+                break
+        else:
+            fault = protocol.PROC_NOT_FOUND
+        if (backend is None):
+            if (d[b'id'] != b'null'):
+                client.writeline(protocol.joinEnvelope([(b'id', d[b'id']),
+                    (b'error', _error((fault.code, fault.message)))]))
+            return
+        backend.forward(client, members)
+
+    def _backend(self, address):
+        '''Get the session with a backend, connecting if necessary.'''
+        backend = self.backends.get(address, None)
+        if (backend is not None and backend._sck is not None):
+            return backend
+        connecting = self._connecting.get(address, None)
+        if (connecting is not None):
+            return connecting.get()
+        connecting = self._connecting[address] = gevent.event.AsyncResult()
+        try:
+            sck = gevent.socket.create_connection(address)
+            backend = BackendSession(self, sck)
+            self.backends[address] = backend
+            gevent.spawn(self._serve_backend, address, backend)
+            logging.info('Backend %s connected.' % backend.name)
+        except socket.error:
+            logging.warning('Cannot connect to backend %s:%s.' % address)
+            backend = None
+        finally:
+            del self._connecting[address]
+            connecting.set(backend)
+        return backend
+
+    def _serve_backend(self, address, backend):
+        '''Process backend message loop.'''
+        backend.serve()
+        backend.abandon()
+        if (self.backends.get(address, None) is backend):
+            del self.backends[address]
+        logging.info('Backend %s disconnected.' % backend.name)
+
+    def stop(self, *args, **kwargs):
+        '''Stop the gateway, and disconnect all backends.'''
+        server.Server.stop(self, *args, **kwargs)
+        for backend in list(self.backends.values()):
+            backend.abandon()
@@ -0,0 +1,138 @@
+# -*- encoding: utf-8 -*-
+# $File: limiter.py
+#
+# Copyright (C) 2012 the pynojo development team <see AUTHORS file>
+#
+# This file is part of pynojo
+#
+# pynojo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynojo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynojo.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function, unicode_literals
+import time, logging
+import gevent
+
+# Adaptive concurrency limit
+#
+# The limiter admits at most `limit` requests at a time, and tunes the
+# limit with AIMD: every request which completes in time while the
+# limit is in use raises it by 1/limit (about 1 per round of requests),
+# and any sign of overload cuts it by a factor, at most once per
+# interval. Overload is either
+#
+# - hub loop lag: a greenlet sleeping for interval seconds wakes up late,
+#   because the hub is busy running other greenlets;
+# - latency: a request takes much longer than the average of its method.
+#
+# Requests over the limit are shed at once with protocol.SERVER_BUSY.
+#
+
+class AdaptiveLimiter(object):
+    '''Concurrency limiter driven by hub loop lag and request latency.'''
+    def __init__(self, initial=100, minimum=4, maximum=100000,
+                 maxLag=0.05, tolerance=3.0, backoff=0.8, interval=0.1):
+        '''
+        Create an adaptive limiter.
+
+        :param initial: Initial concurrency limit.
+        :param minimum: The limit never goes below this.
+        :param maximum: The limit never goes above this.
+
+        :param maxLag: Hub loop lag in seconds regarded as overload.
+        :type maxLag: float.
+
+        :param tolerance: A request taking this many times the average
+            latency of its method is regarded as overload.
+        :type tolerance: float.
+
+        :param backoff: Factor to cut the limit by on overload.
+        :type backoff: float.
+
+        :param interval: Seconds between lag samples.
+        :type interval: float.
+        '''
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.maxLag = maxLag
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.interval = interval
+        self.inflight = 0
+        self.lag = 0.0
+        self.latency = {}       # method -> average latency in seconds
+        self.rejected = 0
+        self._lastDecrease = 0
+        self._watcher = None
+
+    def acquire(self):
+        '''
+        Try to admit a request.
+
+        :return: False if the request should be shed.
+        '''
+        if (self._watcher is None):
+            self._watcher = gevent.spawn(self._watch)
+        if (self.inflight >= int(self.limit)):
+            self.rejected += 1
+            return False
+        self.inflight += 1
+        return True
+
+    def release(self, method, elapsed):
+        '''
+        Finish an admitted request.
+
+        :param method: RPC method name.
+        :param elapsed: Seconds the request took.
+        '''
+        self.inflight -= 1
+        average = self.latency.get(method, None)
+        if (average is None):
+            self.latency[method] = elapsed
+            return
+        self.latency[method] = average * 0.9 + elapsed * 0.1
+        if (elapsed > average * self.tolerance and elapsed > self.maxLag):
+            self._decrease()
+        elif (self.lag <= self.maxLag and
+                self.inflight + 1 >= self.limit / 2):
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def _decrease(self):
+        now = time.time()
+        if (now - self._lastDecrease < self.interval):
+            return
+        self._lastDecrease = now
+        self.limit = max(self.minimum, self.limit * self.backoff)
+        logging.debug('Concurrency limit decreased to %d.' % self.limit)
+
+    def _watch(self):
+        '''Sample hub loop lag.'''
+        try:
+            while True:
+                start = time.time()
+                gevent.sleep(self.interval)
+                lag = max(0.0, time.time() - start - self.interval)
+                self.lag = self.lag * 0.5 + lag * 0.5
+                if (self.lag > self.maxLag):
+                    self._decrease()
+                if (self.inflight == 0 and self.lag <= self.maxLag):
+                    break   # idle, restart on next request
+        finally:
+            self._watcher = None
+
+    def stop(self):
+        '''Stop sampling hub loop lag.'''
+        if (self._watcher is not None):
+            self._watcher.kill()
@@ -0,0 +1,190 @@
+# -*- encoding: utf-8 -*-
+# $File: pending.py
+#
+# Copyright (C) 2012 the pynojo development team <see AUTHORS file>
+#
+# This file is part of pynojo
+#
+# pynojo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynojo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynojo.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function, unicode_literals
+import time
+import gevent, gevent.event
+
+# Request timeouts
+#
+# Arming a gevent timer for every call costs a watcher in the event loop
+# each. Instead, all timeouts go into a hashed timer wheel: a ring of
+# slots, each holding the timers which expire at some tick modulo the
+# ring size. One greenlet turns the wheel, and only while there are
+# timers on it. Timers may fire up to one tick late, never early.
+#
+
+class _Timer(object):
+    __slots__ = ('deadline', 'callback', 'args', 'slot')
+
+class TimerWheel(object):
+    '''Hashed timer wheel.'''
+    def __init__(self, tick=0.05, slots=1024):
+        '''
+        Create a timer wheel.
+
+        :param tick: Seconds per tick.
+        :type tick: float.
+
+        :param slots: Number of slots on the wheel.
+        :type slots: int.
+        '''
+        self.tick = tick
+        self._slots = [set() for i in range(0, slots)]
+        self._start = time.time()
+        self._current = 0       # last tick processed
+        self._count = 0         # timers on the wheel
+        self._runner = None
+
+    def _now(self):
+        return int((time.time() - self._start) / self.tick)
+
+    def schedule(self, seconds, callback, *args):
+        '''
+        Call callback(*args) after the given seconds.
+
+        :return: Timer handle, to be passed to cancel.
+        '''
+        if (self._count == 0):
+            # skip the ticks passed while idle, rather than replaying them
+            self._current = self._now()
+        timer = _Timer()
+        timer.deadline = max(self._now() + int(seconds / self.tick) + 1,
+                             self._current + 1)
+        timer.callback = callback
+        timer.args = args
+        timer.slot = self._slots[timer.deadline % len(self._slots)]
+        timer.slot.add(timer)
+        self._count += 1
+        if (self._runner is None):
+            self._runner = gevent.spawn(self._run)
+        return timer
+
+    def cancel(self, timer):
+        '''Cancel a timer. Nothing happens if it has fired already.'''
+        if (timer.slot is not None):
+            timer.slot.discard(timer)
+            timer.slot = None
+            self._count -= 1
+
+    def _run(self):
+        try:
+            while self._count > 0:
+                gevent.sleep(self.tick)
+                now = self._now()
+                while self._current < now:
+                    self._current += 1
+                    self._expire(self._current)
+        finally:
+            self._runner = None
+
+    def _expire(self, tick):
+        slot = self._slots[tick % len(self._slots)]
+        expired = [t for t in slot if t.deadline <= tick]
+        for timer in expired:
+            self.cancel(timer)
+        for timer in expired:
+            timer.callback(*timer.args)
+
+_wheel = None
+
+def default_wheel():
+    '''Get the timer wheel shared by all sessions.'''
+    global _wheel
+    if (_wheel is None):
+        _wheel = TimerWheel()
+    return _wheel
+
+class PendingTable(object):
+    '''
+    Requests waiting for responses, keyed by request id.
+
+    Ids are allocated without any lock (greenlets do not switch inside
+    the table), and ids still pending are skipped when the counter wraps
+    around.
+    '''
+    MAX_ID = 0xffffffff
+
+    def __init__(self, wheel=None):
+        '''
+        Create a pending request table.
+
+        :param wheel: Timer wheel for timeouts. None to use the shared one.
+        :type wheel: TimerWheel.
+        '''
+        self._wheel = wheel if wheel is not None else default_wheel()
+        self._calls = {}        # id -> (AsyncResult, timer)
+        self._nextId = 1
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __contains__(self, rId):
+        return rId in self._calls
+
+    def nextId(self):
+        '''Get an id which is not pending.'''
+        rId = self._nextId
+        while rId in self._calls:
+            rId = rId + 1 if rId < self.MAX_ID else 1
+        self._nextId = rId + 1 if rId < self.MAX_ID else 1
+        return rId
+
+    def add(self, timeout=None):
+        '''
+        Add a pending request.
+
+        If the response does not arrive within timeout seconds, the
+        result gets gevent.Timeout.
+
+        :return: Tuple (id, gevent.event.AsyncResult).
+        '''
+        rId = self.nextId()
+        result = gevent.event.AsyncResult()
+        timer = None
+        if (timeout is not None):
+            timer = self._wheel.schedule(timeout, self._expire, rId, timeout)
+        self._calls[rId] = (result, timer)
+        return (rId, result)
+
+    def pop(self, rId):
+        '''Remove a request and return its AsyncResult, or None.'''
+        call = self._calls.pop(rId, None)
+        if (call is None):
+            return None
+        if (call[1] is not None):
+            self._wheel.cancel(call[1])
+        return call[0]
+
+    def _expire(self, rId, timeout):
+        result = self.pop(rId)
+        if (result is not None):
+            result.set_exception(gevent.Timeout(timeout))
+
+    def failAll(self, exception):
+        '''Fail all pending requests with the exception.'''
+        calls = self._calls
+        self._calls = {}
+        for result, timer in calls.values():
+            if (timer is not None):
+                self._wheel.cancel(timer)
+        for result, timer in calls.values():
+            result.set_exception(exception)
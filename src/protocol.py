@@ -24,21 +24,9 @@
 #
 
 from __future__ import print_function, unicode_literals
-import logging
+import logging, base64, os, re, sys
 
-# select suitable JSON library
-#
-# Here is the rough speed test of JSON libs
-# http://j2labs.tumblr.com/post/4262756632/speed-tests-for-json-and-
-# cpickle-in-python
-#
-CJSON = False
-try:
-    import cjson
-    CJSON = True
-except ImportError:
-    import simplejson as json
-    logging.info('Cjson is preferred to simplejson in speed.')
+numpy = None            # imported when the first array is met
 
 # For later extending, I choose JSON RPC to transport data between 
 # controller and clients. However,  I didn't follow the JSON specification 
@@ -52,9 +40,15 @@ class Fault(Exception):
         Exception.__init__(self, *((code, message) + args), **kwargs)
         self.code = code
         self.message = message
+        
+    def __setattr__(self, name, value):
+        if (getattr(self, '_shared', False)):
+            raise AttributeError('Shared Fault instances are read-only.')
+        Exception.__setattr__(self, name, value)
 
-(FAULT_SERVER_ERROR, FAULT_INVALID_JSON_RPC, FAULT_PROC_NOT_FOUND,  
- FAULT_PARAMS_INVALID, FAULT_PARSE_ERROR, ) = (
+(FAULT_SERVER_BUSY, FAULT_SERVER_ERROR, FAULT_INVALID_JSON_RPC, 
+ FAULT_PROC_NOT_FOUND, FAULT_PARAMS_INVALID, FAULT_PARSE_ERROR, ) = (
+    (-32000, 'Server busy, retry later.'), # Non-standard
     (-32500, 'Internal server error.'), # Non-standard
     (-32600, 'Invalid JSON-RPC message.'),
     (-32601, 'Procedure not found.'),
@@ -62,21 +56,246 @@ class Fault(Exception):
     (-32700, 'Parse error.'),
 )
 
-# Protocol parse
-if (CJSON):
-    json_encode = cjson.encode
-    json_decode = cjson.decode
-    JsonEncodeError = cjson.EncodeError
-    JsonDecodeError = cjson.DecodeError
-else:
-    json_encode = json.dumps
-    json_decode = json.loads
-    JsonEncodeError = TypeError
-    JsonDecodeError = json.JSONDecodeError
+# Shared Fault instances of the codes above. Error paths inside the 
+# protocol put them into responses directly, instead of allocating and 
+# raising a new exception for every bad message. Code which raises a 
+# Fault should still make a new one.
+def _shared_fault(spec):
+    ret = Fault(*spec)
+    ret._shared = True
+    return ret
+
+(SERVER_BUSY, SERVER_ERROR, INVALID_JSON_RPC, PROC_NOT_FOUND, 
+ PARAMS_INVALID, PARSE_ERROR, ) = [_shared_fault(f) for f in (
+    FAULT_SERVER_BUSY, FAULT_SERVER_ERROR, FAULT_INVALID_JSON_RPC, 
+    FAULT_PROC_NOT_FOUND, FAULT_PARAMS_INVALID, FAULT_PARSE_ERROR, )]
+
+# select suitable JSON library
+#
+# Every backend is a function which imports the library and returns the
+# tuple (encode, decode, DecodeError). Encoders produce compact output, 
+# and may return either a byte string or text. Decoders accept both.
+# Run bench.py to see how the installed backends compare.
+#
+# The backends encode the same values alike, with one exception: NaN and
+# infinities, which JSON has no notation for, are written as NaN and
+# Infinity by json and ujson, as null by orjson, and refused by newer
+# simplejson. Non-string dict keys and integers beyond 64 bits, which 
+# orjson cannot handle itself, are encoded as json would.
+#
+# Nothing is imported until the first message is encoded or decoded, so
+# that importing the protocol stays cheap for short-lived clients.
+#
+def _orjson():
+    import orjson, json
+    def encode(obj):
+        try:
+            return orjson.dumps(obj, default=_ext_default, 
+                                option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            # integers beyond 64 bits, or objects which nothing encodes
+            return json.dumps(obj, separators=(',', ':'), 
+                              default=_ext_default)
+    return (encode, orjson.loads, orjson.JSONDecodeError)
+
+def _ujson():
+    import ujson
+    try:
+        ujson.dumps(None, default=None)
+    except TypeError:
+        raise ImportError('ujson is too old to support extension types.')
+    def encode(obj):
+        return ujson.dumps(obj, ensure_ascii=False, default=_ext_default)
+    return (encode, ujson.loads, ValueError)
+
+def _simplejson():
+    import simplejson as json
+    def encode(obj):
+        return json.dumps(obj, separators=(',', ':'), default=_ext_default)
+    return (encode, json.loads, ValueError)
+    
+def _json():
+    import json
+    def encode(obj):
+        return json.dumps(obj, separators=(',', ':'), default=_ext_default)
+    return (encode, json.loads, ValueError)
+
+JSON_BACKENDS = (
+    ('orjson', _orjson),
+    ('ujson', _ujson),
+    ('json', _json),
+    ('simplejson', _simplejson),
+)
+JsonEncodeError = TypeError
+# The errors of all backends derive from ValueError. It is narrowed to the
+# error of the selected backend once it is loaded.
+JsonDecodeError = ValueError
+json_backend = None
+
+def use_backend(name=None):
+    '''
+    Select the JSON backend.
+    
+    :param name: Name in JSON_BACKENDS. None to pick the fastest one 
+        installed.
+    :type name: unicode.
+    
+    :return: Name of the selected backend.
+    '''
+    global json_backend, json_encode, _json_decode, JsonDecodeError
+    for n, backend in JSON_BACKENDS:
+        if (name is not None and n != name):
+            continue
+        try:
+            json_encode, _json_decode, JsonDecodeError = backend()
+        except ImportError:
+            continue
+        json_backend = n
+        return n
+    raise ImportError('JSON backend %s is not available.' % name)
+    
+def load_backend():
+    '''
+    Load the JSON backend named by the JSON_RPC_BACKEND environment 
+    variable, or the fastest one installed, unless one is selected.
+    
+    :return: Name of the selected backend.
+    '''
+    if (json_backend is not None):
+        return json_backend
+    try:
+        use_backend(os.environ.get('JSON_RPC_BACKEND', None))
+    except ImportError:
+        logging.warning('JSON backend %s is not available.' 
+                        % os.environ['JSON_RPC_BACKEND'])
+        use_backend()
+    logging.debug('Use %s as the JSON backend.' % json_backend)
+    return json_backend
+
+# Stand-ins until the backend is loaded. The functions are looked up as 
+# globals on every call, so they are replaced by the backend's ones.
+def json_encode(obj):
+    load_backend()
+    return json_encode(obj)
+
+def _json_decode(s):
+    load_backend()
+    return _json_decode(s)
+
+def json_decode(s):
+    return _ext_restore(_json_decode(s), s)
+
+# Extension types
+#
+# JSON has no binary type, so values of the registered types travel as
+# objects like {"__ext__": "bytes", "data": "<base64>"}. The encoder only
+# sees them through the default hook, and the decoder only walks the 
+# result if the marker appears in the raw message, so plain messages pay 
+# nothing for the feature.
+#
+_EXT_KEY = '__ext__'
+_EXT_MARK = '"__ext__"'
+_EXT_MARK_BYTES = b'"__ext__"'
+_extensions = {}        # tag -> (type, encoder, decoder)
+
+def register_extension(tag, cls, encoder, decoder):
+    '''
+    Register an extension type.
+    
+    :param tag: Name of the extension on the wire.
+    :type tag: unicode.
+    
+    :param cls: Type of the values to be encoded.
+    :type cls: type.
+    
+    :param encoder: Make a JSON dict from the value. The "__ext__" key 
+        will be added by the protocol.
+    :type encoder: callable(value) -> dict.
+    
+    :param decoder: Rebuild the value from the JSON dict.
+    :type decoder: callable(dict) -> value.
+    '''
+    _extensions[tag] = (cls, encoder, decoder)
+
+def _ext_default(obj):
+    if (numpy is None and 'numpy' in sys.modules and _register_ndarray()):
+        return _ext_default(obj)
+    for tag, (cls, encoder, decoder) in _extensions.items():
+        if (isinstance(obj, cls)):
+            ret = encoder(obj)
+            ret[_EXT_KEY] = tag
+            return ret
+    raise TypeError('%r is not JSON serializable.' % type(obj))
+
+def _ext_walk(obj):
+    if (isinstance(obj, dict)):
+        tag = obj.get(_EXT_KEY, None)
+        if (tag == 'ndarray' and numpy is None):
+            _register_ndarray()
+        if (tag is not None and tag in _extensions):
+            return _extensions[tag][2](obj)
+        for k, v in obj.items():
+            obj[k] = _ext_walk(v)
+    elif (isinstance(obj, list)):
+        for i, v in enumerate(obj):
+            obj[i] = _ext_walk(v)
+    return obj
+
+def _ext_restore(obj, s):
+    mark = _EXT_MARK_BYTES if isinstance(s, bytes) else _EXT_MARK
+    if (mark not in s):
+        return obj
+    try:
+        return _ext_walk(obj)
+    except (KeyError, TypeError, ValueError):
+        raise JsonDecodeError('Bad extension value.', s, 0)
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+# Binary strings. Under Python 2 str is text as well, so only bytearray 
+# is treated as binary there.
+BINARY_TYPE = bytearray if bytes is str else bytes
+register_extension('bytes', (bytes, bytearray) if bytes is not str 
+                                                else bytearray,
+                   lambda v: {'data': _b64encode(bytes(v))},
+                   lambda d: BINARY_TYPE(base64.b64decode(d['data'])))
+
+# NumPy arrays. The raw buffer is sent as it is, and rebuilt with 
+# numpy.frombuffer, so no per-element work is done on either side.
+# The array is built over a bytearray, so that it is writable like the
+# one which was sent.
+# NumPy is imported once an array is to be encoded (it must have been 
+# imported by the caller then) or decoded.
+def _ndarray_encode(a):
+    a = numpy.ascontiguousarray(a)
+    if (a.dtype.hasobject):
+        raise TypeError('Cannot encode object arrays.')
+    return {'dtype': a.dtype.str, 'shape': list(a.shape),
+            'data': _b64encode(a.tobytes() if hasattr(a, 'tobytes') 
+                                           else a.tostring())}
+    
+def _ndarray_decode(d):
+    return numpy.frombuffer(bytearray(base64.b64decode(d['data'])),
+                            dtype=numpy.dtype(str(d['dtype']))
+                           ).reshape(d['shape'])
+
+def _register_ndarray():
+    '''Import NumPy and register its arrays, if it is installed.'''
+    global numpy
+    try:
+        import numpy
+    except ImportError:
+        return False
+    register_extension('ndarray', numpy.ndarray, 
+                       _ndarray_encode, _ndarray_decode)
+    return True
 
 # Protocol Request
 class Request(object):
-    def __init__(self, method, params=None, id=None):
+    __slots__ = ('id', 'method', 'params', 'trace')
+    
+    def __init__(self, method, params=None, id=None, trace=None):
         '''
         Create a JSON RPC request object.
         
@@ -89,47 +308,46 @@ class Request(object):
             
         :param id: JSON request id.
         :type id: int.
+        
+        :param trace: Non-standard. Trace context of the caller, see 
+            the tracing module.
+        :type trace: None or dict.
         '''
         self.id = id
         self.method = method
         self.params = params
+        self.trace = trace
         
     def toJSON(self):
         '''Generate JSON RPC request string.'''
+        return Request.encode(self.method, self.params, self.id, 
+                              self.trace)
+    
+    @staticmethod
+    def encode(method, params=None, id=None, trace=None):
+        '''Generate JSON RPC request string without making a Request.'''
         try:
-            obj = {'id': self.id, 'method': self.method}
-            if (self.params is not None):
-                obj['params'] = self.params
+            obj = {'id': id, 'method': method}
+            if (params is not None):
+                obj['params'] = params
+            if (trace is not None):
+                obj['trace'] = trace
             return json_encode(obj)
-        except JsonEncodeError:
-            raise Fault(*FAULT_SERVER_ERROR)
         except Exception:
             raise Fault(*FAULT_SERVER_ERROR)
         
     @staticmethod
     def fromJSON(s):
         '''Make request from JSON RPC string.'''
-        req = None
-        try:
-            req = json_decode(s)
-        except JsonDecodeError:
-            raise Fault(*FAULT_PARSE_ERROR)
-        
-        if (not isinstance(req, dict)):
-            raise Fault(*FAULT_INVALID_JSON_RPC)
-        if ('id' not in req or 'method' not in req
-                or req['method'] is None):
+        ret = fromObject(_decode(s))
+        if (not isinstance(ret, Request)):
             raise Fault(*FAULT_INVALID_JSON_RPC)
-        if ('params' in req and
-            (not isinstance(req['params'], dict)
-                and not isinstance(req['params'], list)
-                and not isinstance(req['params'], tuple))):
-            raise Fault(*FAULT_INVALID_JSON_RPC)
-        
-        return Request(req['method'], req.get('params', None), req['id'])
+        return ret
         
 class Response(object):
-    def __init__(self, result=None, error=None, id=None):
+    __slots__ = ('id', 'result', 'error', 'cache')
+    
+    def __init__(self, result=None, error=None, id=None, cache=None):
         '''
         Create a JSON RPC response object.
         
@@ -141,53 +359,110 @@ class Response(object):
         
         :param id: JSON response id.
         :type id: int.
+        
+        :param cache: Non-standard. The result may be cached by the 
+            caller, see Cacheable.
+        :type cache: None or dict {"version": ..., "ttl": seconds}.
         '''
         self.id = id
         self.result = result
         self.error = error
+        self.cache = cache
         
     def isError(self):
         return self.error is not None
         
     def toJSON(self):
         '''Generate JSON RPC response string.'''
+        return Response.encode(self.result, self.error, self.id, 
+                               self.cache)
+    
+    @staticmethod
+    def encode(result=None, error=None, id=None, cache=None):
+        '''Generate JSON RPC response string without making a Response.'''
         try:
-            obj = {'id': self.id}
-            if (self.error is not None):
-                obj['error'] = {'code': self.error.code, 
-                                'message': self.error.message}
+            obj = {'id': id}
+            if (error is not None):
+                obj['error'] = {'code': error.code, 
+                                'message': error.message}
             else:
-                obj['result'] = self.result
+                obj['result'] = result
+                if (cache is not None):
+                    obj['cache'] = cache
             return json_encode(obj)
-        except JsonEncodeError:
-            raise Fault(*FAULT_SERVER_ERROR)
         except Exception:
+            logging.exception('Cannot encode response %s.' % id)
             raise Fault(*FAULT_SERVER_ERROR)
         
     @staticmethod
     def fromJSON(s):
         '''Make response from JSON RPC string.'''
-        req = None
-        try:
-            req = json_decode(s)
-        except JsonDecodeError:
-            raise Fault(*FAULT_PARSE_ERROR)
-        
-        if (not isinstance(req, dict)):
+        ret = fromObject(_decode(s))
+        if (not isinstance(ret, Response)):
             raise Fault(*FAULT_INVALID_JSON_RPC)
-        if ('id' not in req):
-            raise Fault(*FAULT_INVALID_JSON_RPC)
-        
-        result = error = None
-        if ('error' in req):
-            error = req['error']
-            if ('code' not in error or 'message' not in error):
-                raise Fault(*FAULT_INVALID_JSON_RPC)
-            error = Fault(error['code'], error['message'])
-        else:
-            result = req['result']
-        
-        return Response(result, error, req['id'])
+        return ret
+    
+def _decode(s):
+    try:
+        return json_decode(s)
+    except JsonDecodeError:
+        raise Fault(*FAULT_PARSE_ERROR)
+
+# The only place where messages are validated. Invalid messages get a 
+# shared Fault returned rather than raised.
+def _validate(obj):
+    if (not isinstance(obj, dict) or 'id' not in obj):
+        return INVALID_JSON_RPC
+    
+    # assume a request
+    if ('method' in obj):
+        if (obj['method'] is None or 'params' in obj and
+                not isinstance(obj['params'], (dict, list, tuple))):
+            return INVALID_JSON_RPC
+        trace = obj.get('trace', None)
+        if (trace is not None and 
+                (not isinstance(trace, dict) or 'trace_id' not in trace)):
+            trace = None
+        return Request(obj['method'], obj.get('params', None), obj['id'],
+                       trace)
+    
+    # assume a response
+    result = error = None
+    if ('error' in obj):
+        error = obj['error']
+        if (not isinstance(error, dict) or 'code' not in error 
+                or 'message' not in error):
+            return INVALID_JSON_RPC
+        # the error will be raised to the caller, so never share it
+        error = Fault(error['code'], error['message'])
+    elif ('result' in obj):
+        result = obj['result']
+    else:
+        return INVALID_JSON_RPC
+    
+    cache = obj.get('cache', None)
+    if (cache is not None and not isinstance(cache, dict)):
+        cache = None
+    return Response(result, error, obj['id'], cache)
+
+def fromObject(obj):
+    '''
+    Make request or response from decoded JSON object.
+    
+    Raise Fault if the object is not a valid JSON RPC message.
+    '''
+    ret = _validate(obj)
+    if (isinstance(ret, Fault)):
+        raise Fault(ret.code, ret.message)
+    return ret
+    
+def _parse(obj):
+    ret = _validate(obj)
+    if (isinstance(ret, Fault)):
+        if (isinstance(obj, dict) and 'id' in obj and 'method' in obj):
+            return (ret, obj['id'])
+        return None
+    return ret
     
 # auto detect input is a request or a response
 # and return the object
@@ -195,52 +470,233 @@ def parseJson(s):
     '''
     Make request or response from JSON RPC string.
     
+    The string is decoded only once, and may be a byte string as read 
+    from the socket.
+    
     It the request string is like a request, and it is not valid, a tuple
     (Fault, id) will be returned to indicate the error. Otherwise, any 
     error input will get a None.
-    '''
-    ret = None
-    m_id = None
-    intend_to_be_request = False
     
+    A JSON RPC 2.0 batch gets a list, with one of the above for each 
+    message in it.
+    '''
     try:
-        try:
-            ret = json_decode(s)
-        except JsonDecodeError:
-            raise Fault(*FAULT_PARSE_ERROR)
-        
-        if (not isinstance(ret, dict)):
-            raise Fault(*FAULT_INVALID_JSON_RPC)
-        if ('id' not in ret):
-            raise Fault(*FAULT_INVALID_JSON_RPC)
-        m_id = ret['id']
-    
-        # assume a request
-        if ('method' in ret):
-            intend_to_be_request = True
-            if (ret['method'] is None or
-                'params' in ret and
-                (not isinstance(ret['params'], dict)
-                    and not isinstance(ret['params'], list)
-                    and not isinstance(ret['params'], tuple))):
-                raise Fault(*FAULT_INVALID_JSON_RPC)
-            return Request(ret['method'], ret.get('params', None), ret['id'])
-    
-        # assume a response
-        result = error = None
-        if ('error' in ret):
-            error = ret['error']
-            if ('code' not in error or 'message' not in error):
-                raise Fault(*FAULT_INVALID_JSON_RPC)
-            error = Fault(error['code'], error['message'])
+        obj = json_decode(s)
+    except JsonDecodeError:
+        return None
+    if (isinstance(obj, list)):
+        return [_parse(o) for o in obj] if obj else None
+    return _parse(obj)
+
+def joinBatch(messages):
+    '''
+    Join encoded messages into a JSON RPC 2.0 batch.
+    
+    :param messages: JSON RPC strings, all of the same string type.
+    :type messages: list.
+    '''
+    if (isinstance(messages[0], bytes)):
+        return b'[' + b','.join(messages) + b']'
+    return '[' + ','.join(messages) + ']'
+
+# Envelope parse
+#
+# A proxy only needs the id and the method of a message. The scanner 
+# below splits the top level object into its members and leaves every 
+# value as raw JSON text, so that params and results can be forwarded 
+# without being decoded and encoded again. It checks the structure only 
+# as far as needed to find where each member ends.
+#
+# Messages are scanned as byte strings, as they are read from the socket.
+# Strings are skipped with bytes.find. Nested values are skipped from one
+# bracket to the next, counting the quotes in between to tell whether the
+# bracket is inside a string, so that only brackets cost a step each.
+#
+_WS = re.compile(br'[ \t\r\n]*')
+_SCALAR = re.compile(br'[^,}\][ \t\r\n]+')
+_BRACKET = re.compile(br'[\[\]{}]')
+_BRACKETS = (b'{', b'[', b'}', b']')
+_OPEN = _BRACKETS[0:2]
+
+def _skip_string(s, i):
+    '''Get the end of the string starting at i, or i if it is unclosed.'''
+    j = s.find(b'"', i + 1)
+    while j > 0:
+        k = j - 1
+        while s[k:k + 1] == b'\\':
+            k -= 1
+        if ((j - k) % 2 == 1):
+            return j + 1
+        j = s.find(b'"', j + 1)
+    return i
+
+def _string_over(s, i, b):
+    '''
+    Get the end of the string which the byte at b is in, 0 if it is in 
+    none, or -1 if the string is not closed. No string is open at i.
+    '''
+    q = s.find(b'"', i, b)
+    if (q < 0):
+        return 0
+    if (s.find(b'\\', q, b) < 0):
+        quotes = s.count(b'"', q, b)
+    else:
+        # drop escaped backslashes, then every escaped quote is a \"
+        run = s[q:b].replace(b'\\\\', b'')
+        quotes = run.count(b'"') - run.count(b'\\"')
+    if (quotes % 2 == 0):
+        return 0
+    j = _skip_string(s, b)
+    return -1 if j == b else j
+
+def _skip_nested(s, start):
+    '''Get the end of the array or object at start, or start if unclosed.'''
+    depth = 0
+    i = start
+    ahead = [start - 2] * 4     # next of each bracket past the window
+    while True:
+        # the regex is quick over short runs, find over long strings
+        m = _BRACKET.search(s, i, i + 4096)
+        if (m is not None):
+            b = m.start()
+            c = m.group()
         else:
-            result = ret['result']
-        
-        return Response(result, error, ret['id'])
-    except Fault as e:
-        if (intend_to_be_request):
-            return (e, m_id)
+            b = -1
+            for k in range(0, 4):
+                if (ahead[k] != -1 and ahead[k] < i):
+                    ahead[k] = s.find(_BRACKETS[k], i)
+                if (ahead[k] >= 0 and (b < 0 or ahead[k] < b)):
+                    b = ahead[k]
+                    c = _BRACKETS[k]
+            if (b < 0):
+                return start
+        j = _string_over(s, i, b)
+        if (j < 0):
+            return start
+        if (j > 0):
+            i = j
+            continue
+        if (c in _OPEN):
+            depth += 1
+        else:
+            depth -= 1
+            if (depth == 0):
+                return b + 1
+        i = b + 1
+
+def _skip_value(s, i):
+    c = s[i:i + 1]
+    if (c == b'"'):
+        return _skip_string(s, i)
+    if (c == b'{' or c == b'['):
+        return _skip_nested(s, i)
+    m = _SCALAR.match(s, i)
+    return m.end() if m else i
+
+def _scan(s, close, member):
+    '''Scan the members of an object or an array, starting at its opening.'''
+    ret = []
+    i = _WS.match(s, 1).end()
+    if (s[i:i + 1] == close):
+        return ret
+    while True:
+        m = member(s, i)
+        if (m is None):
+            return None
+        item, i = m
+        ret.append(item)
+        i = _WS.match(s, i).end()
+        c = s[i:i + 1]
+        if (c == close):
+            return ret
+        if (c != b','):
+            return None
+        i = _WS.match(s, i + 1).end()
+
+def _object_member(s, i):
+    if (s[i:i + 1] != b'"'):
+        return None
+    j = _skip_string(s, i)
+    if (j == i):
+        return None
+    name = s[i + 1:j - 1]
+    i = _WS.match(s, j).end()
+    if (s[i:i + 1] != b':'):
+        return None
+    i = _WS.match(s, i + 1).end()
+    j = _skip_value(s, i)
+    if (j == i):
+        return None
+    return ((name, s[i:j]), j)
+
+def _array_item(s, i):
+    j = _skip_value(s, i)
+    if (j == i):
+        return None
+    return (s[i:j], j)
+
+def _bytes(s):
+    return s if isinstance(s, bytes) else s.encode('utf-8')
+
+def parseEnvelope(s):
+    '''
+    Split a JSON RPC message into its members without decoding them.
+    
+    :param s: The message. Text is encoded to UTF-8 first.
+    
+    :return: List of tuple (name, raw JSON value), both byte strings, in 
+        the order of the message. Names are left escaped as they were. 
+        None if the message is not a JSON object.
+    '''
+    s = _bytes(s).strip()
+    if (s[0:1] != b'{'):
+        return None
+    return _scan(s, b'}', _object_member)
+
+def splitBatch(s):
+    '''
+    Split a JSON RPC 2.0 batch into its messages without decoding them.
+    
+    :return: List of raw messages as byte strings. None if the message is 
+        not a JSON array.
+    '''
+    s = _bytes(s).strip()
+    if (s[0:1] != b'['):
         return None
+    return _scan(s, b']', _array_item)
+
+def joinEnvelope(members):
+    '''
+    Make JSON RPC message from the members given by parseEnvelope.
+    
+    :param members: Tuple (name, raw JSON value). Either may be text.
+    :return: The message as a byte string.
+    '''
+    return b'{' + b','.join([b'"' + _bytes(name) + b'":' + _bytes(value) 
+                             for name, value in members]) + b'}'
+
+# Cacheable result
+class Cacheable(object):
+    '''
+    Return value of RPC methods, marking the result as cacheable by the 
+    caller. Call Server.invalidate when the result changes.
+    '''
+    __slots__ = ('result', 'version', 'ttl')
+    
+    def __init__(self, result, version=None, ttl=None):
+        '''
+        :param result: The result.
+        
+        :param version: Version tag of the result.
+        :type version: anything JSON serializable.
+        
+        :param ttl: Seconds the result may be cached. None for as long as 
+            the caller likes.
+        :type ttl: float.
+        '''
+        self.result = result
+        self.version = version
+        self.ttl = ttl
 
 # Service object decorator
 def expose(f, is_expose=True):
@@ -304,28 +760,30 @@ class Dispatcher(object):
         :return Response.
         '''
         req = request
+        # get method
         try:
-            # get method
             method = getattr(self.handler, req.method, None)
-            if (not callable(method) or not is_exposed(method)):
-                raise Fault(*FAULT_PROC_NOT_FOUND)
-            # call method
-            ret = None
-            try:
-                if (req.params is None):
-                    ret = self._call(method)
-                elif (isinstance(req.params, dict)):
-                    ret = self._call(method, **req.params)
-                else:
-                    ret = self._call(method, *req.params)
-            except TypeError:
-                raise Fault(*FAULT_PARAMS_INVALID)
-            except Exception:
-                logging.exception('RPC method `%s` raised exception.'
-                                   % req.method)
-                raise Fault(*FAULT_SERVER_ERROR)
-            # make result
-            return Response(ret, None, req.id)
-        except Fault as fault:
-            # return error
-            return Response(None, fault, req.id)
+        except TypeError:
+            method = None   # method name is not a string
+        if (not callable(method) or not is_exposed(method)):
+            return Response(None, PROC_NOT_FOUND, req.id)
+        # call method
+        ret = None
+        try:
+            if (req.params is None):
+                ret = self._call(method)
+            elif (isinstance(req.params, dict)):
+                ret = self._call(method, **req.params)
+            else:
+                ret = self._call(method, *req.params)
+        except TypeError:
+            return Response(None, PARAMS_INVALID, req.id)
+        except Exception:
+            logging.exception('RPC method `%s` raised exception.'
+                               % req.method)
+            return Response(None, SERVER_ERROR, req.id)
+        # make result
+        if (isinstance(ret, Cacheable)):
+            return Response(ret.result, None, req.id, 
+                            {'version': ret.version, 'ttl': ret.ttl})
+        return Response(ret, None, req.id)
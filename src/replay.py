@@ -0,0 +1,238 @@
+# -*- encoding: utf-8 -*-
+# $File: replay.py
+#
+# Copyright (C) 2012 the pynojo development team <see AUTHORS file>
+#
+# This file is part of pynojo
+#
+# pynojo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynojo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynojo.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function, unicode_literals
+import sys, time, json, socket, logging
+import gevent, gevent.event, gevent.socket
+
+import protocol, capture
+
+# Replay captured traffic against a server.
+#
+# Usage: python replay.py run <host:port> <capture> [speed] [result.json]
+#        python replay.py compare <before.json> <after.json>
+#
+# Every connection of a server-side capture is opened again, and the
+# requests it read are sent in their order, at their recorded times
+# divided by speed ("max" to send them as fast as possible). Latencies
+# of the responses are compared with the recorded ones, and may be
+# saved to compare two builds of the server. Note that recorded latencies
+# are taken inside the server, while replayed ones include the round trip
+# and the queueing of pipelined requests, so builds are best compared by
+# their replayed latencies at the same speed.
+#
+
+def _messages(frame):
+    '''Get the envelopes of the messages in a frame, or of a batch.'''
+    batch = protocol.splitBatch(frame)
+    ret = []
+    for msg in (batch if batch else [frame]):
+        members = protocol.parseEnvelope(msg)
+        if (members is not None):
+            ret.append(dict(members))
+    return ret
+
+def load(paths):
+    '''
+    Load the requests of a server-side capture.
+
+    :return: Dict connection -> list of tuple (time, frame, calls), one
+        for each frame of requests, which may be a batch. Calls are lists
+        [raw id, method, recorded latency], one for each request in the 
+        frame. The latency is None for notifications, and requests whose
+        response is not in the capture.
+    '''
+    connections = {}
+    waiting = {}        # (connection, raw id) -> (frame time, call)
+    start = None
+    for t, direction, conn, frame in capture.read_capture(paths):
+        if (start is None):
+            start = t
+        messages = _messages(frame)
+        calls = []
+        for d in messages:
+            if (direction == 'i' and b'method' in d):
+                call = [d.get(b'id', b'null'), 
+                        protocol.json_decode(d[b'method']), None]
+                calls.append(call)
+                if (call[0] != b'null'):
+                    waiting[(conn, call[0])] = (t - start, call)
+            elif (direction == 'o' and b'method' not in d and b'id' in d):
+                entry = waiting.pop((conn, d[b'id']), None)
+                if (entry is not None):
+                    entry[1][2] = t - start - entry[0]
+        if (calls):
+            connections.setdefault(conn, []).append((t - start, frame, 
+                                                     calls))
+        elif (not messages):
+            logging.warning('Cannot parse captured frame %r.' % frame[:80])
+    return connections
+
+def _line(msg):
+    if (not isinstance(msg, bytes)):
+        msg = msg.encode('utf-8')
+    return msg + b'\n'
+
+def _replay_connection(address, requests, start, speed, timeout, results):
+    '''Send the requests of a connection, and time their responses.'''
+    sck = gevent.socket.create_connection(address)
+    fp = sck.makefile('rb')
+    pending = {}        # raw id -> (method, sent, recorded latency)
+    done = gevent.event.Event()
+
+    def read():
+        try:
+            for line in fp:
+                for d in _messages(line.strip()):
+                    handle(d)
+                if (not pending and done.is_set()):
+                    break
+        except socket.error:
+            pass
+
+    def handle(d):
+        if (b'method' in d):
+            if (d.get(b'id', b'null') != b'null'):
+                sck.sendall(_line(protocol.joinEnvelope([
+                        (b'id', d[b'id']),
+                        (b'error', '{"code":%d,"message":"%s"}'
+                                   % protocol.FAULT_PROC_NOT_FOUND)])))
+            return
+        call = pending.pop(d.get(b'id', None), None)
+        if (call is not None):
+            results.append((call[0], call[2], time.time() - call[1]))
+
+    reader = gevent.spawn(read)
+    try:
+        for offset, frame, calls in requests:
+            if (speed is not None):
+                delay = start + offset / speed - time.time()
+                if (delay > 0):
+                    gevent.sleep(delay)
+            for rawId, method, recorded in calls:
+                if (rawId != b'null'):
+                    pending[rawId] = (method, time.time(), recorded)
+            sck.sendall(_line(frame))
+        done.set()
+        if (pending):
+            reader.join(timeout)
+    finally:
+        reader.kill()
+        if (pending):
+            logging.warning('%d requests not answered.' % len(pending))
+        sck.close()
+
+def replay(address, paths, speed=1.0, timeout=10):
+    '''
+    Drive a server with captured traffic.
+
+    :param address: Tuple (host, port) of the server.
+    :param paths: Capture files, oldest first.
+
+    :param speed: Times the recorded rate. None to send as fast as
+        possible.
+    :type speed: float.
+
+    :param timeout: Seconds to wait for responses after the last request
+        of a connection.
+
+    :return: List of tuple (method, recorded latency, replayed latency),
+        one for each request answered.
+    '''
+    connections = load(paths)
+    results = []
+    start = time.time()
+    gevent.joinall([gevent.spawn(_replay_connection, address, requests,
+                                 start, speed, timeout, results)
+                    for requests in connections.values()])
+    return results
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def summarize(results):
+    '''
+    Summarize latencies by method.
+
+    :return: Dict method -> dict with count, and p50 and p99 of the
+        recorded and replayed latencies in seconds.
+    '''
+    byMethod = {}
+    for method, recorded, replayed in results:
+        byMethod.setdefault(method, ([], []))
+        if (recorded is not None):
+            byMethod[method][0].append(recorded)
+        byMethod[method][1].append(replayed)
+    ret = {}
+    for method, (recorded, replayed) in byMethod.items():
+        s = {'count': len(replayed)}
+        for name, values in (('recorded', recorded), ('replayed', replayed)):
+            if (values):
+                s[name + '_p50'] = _percentile(values, 0.5)
+                s[name + '_p99'] = _percentile(values, 0.99)
+        ret[method] = s
+    return ret
+
+def report(before, after, beforeKey, afterKey, names=None):
+    '''
+    Print the latencies of two summaries side by side.
+
+    :param beforeKey: Latencies to take from before, "recorded" or
+        "replayed". So is afterKey from after.
+    :param names: Column titles of the two. None to use the keys.
+    '''
+    names = names or (beforeKey, afterKey)
+    print('%-24s %7s %10s %10s %10s %10s %8s' % (
+            'method', 'count', names[0] + ' p50', 'p99',
+            names[1] + ' p50', 'p99', 'p50 diff'))
+    for method in sorted(set(before) | set(after)):
+        b = before.get(method, {})
+        a = after.get(method, {})
+        row = [b.get(beforeKey + '_p50'), b.get(beforeKey + '_p99'),
+               a.get(afterKey + '_p50'), a.get(afterKey + '_p99')]
+        diff = ('%+7.1f%%' % ((row[2] - row[0]) * 100.0 / row[0])
+                if row[0] and row[2] is not None else '')
+        print('%-24s %7d %s %s' % (method, a.get('count', b.get('count', 0)),
+              ' '.join('%8.2fms' % (v * 1000) if v is not None
+                       else '%10s' % '-' for v in row), diff))
+
+if __name__ == '__main__':
+    if (len(sys.argv) >= 4 and sys.argv[1] == 'run'):
+        host, port = sys.argv[2].rsplit(':', 1)
+        speed = sys.argv[4] if len(sys.argv) > 4 else '1'
+        summary = summarize(replay((host, int(port)),
+                                   capture.capture_files(sys.argv[3]),
+                                   None if speed == 'max' else float(speed)))
+        report(summary, summary, 'recorded', 'replayed')
+        if (len(sys.argv) > 5):
+            with open(sys.argv[5], 'w') as fp:
+                json.dump(summary, fp, indent=1)
+    elif (len(sys.argv) == 4 and sys.argv[1] == 'compare'):
+        with open(sys.argv[2]) as fp:
+            before = json.load(fp)
+        with open(sys.argv[3]) as fp:
+            after = json.load(fp)
+        report(before, after, 'replayed', 'replayed', ('before', 'after'))
+    else:
+        print('Usage: python replay.py run <host:port> <capture> '
+              '[speed|max] [result.json]\n'
+              '       python replay.py compare <before.json> <after.json>')
@@ -25,10 +25,12 @@
 
 from __future__ import print_function, unicode_literals
 from gevent.server import StreamServer
+import gevent, gevent.event, gevent.queue
 import logging
 
 import session
 import protocol
+import tls
 import time
 import ssl
 
@@ -64,11 +66,18 @@ class ServerSession(session.Session):
     def echo(self, message):
         return message
         
+    def _dispatch(self, request):
+        '''Remember the clients holding cacheable results.'''
+        ret = super(ServerSession, self)._dispatch(request)
+        if (ret.cache is not None):
+            self.server.cacheHolders.setdefault(request.method, 
+                                                set()).add(self)
+        return ret
+        
     def _got_badmessage(self, msg):
         '''On bad message received.'''
-        self.writeline(protocol.Response(error=
-                          protocol.Fault(*protocol.FAULT_INVALID_JSON_RPC)
-                    ).toJSON())
+        self.writeline(protocol.Response.encode(
+                          error=protocol.INVALID_JSON_RPC))
         self.abandon()
     
 # RPC server
@@ -90,20 +99,106 @@ class Server(StreamServer):
         self.SessionClass = sessionClass
         self.clients = {}
         self.verbose = verbose
+        self.shmThreshold = None # see Session.shmThreshold
+        # Broadcasts arriving within this many seconds are sent to each 
+        # client as one batch. None to send them one by one.
+        self.broadcastWindow = None
+        # limiter.AdaptiveLimiter shared by all sessions. None to admit 
+        # all requests.
+        self.limiter = None
+        self.cacheHolders = {}  # method -> sessions holding its results
+        self.tracer = None      # tracing.Tracer for all sessions
+        self.recorder = None    # capture.Recorder for all sessions
+        # Sessions receiving nothing for this many seconds are parked: 
+        # their greenlet exits, and the event loop watches the socket 
+        # until it gets readable again. None to keep a greenlet each.
+        self.idleTimeout = None
+        self._parked = {}       # address -> (session, io watcher)
+        # TLS configuration, see tls.server_context. Handshakes run in 
+        # handshakePool (None for tls.default_pool()), once the client 
+        # starts one within handshakeWait seconds, and connections over 
+        # handshakeLimit (tls.RateLimit) are dropped before them. The 
+        # ssl_args of StreamServer still handshake on the hub.
+        self.sslContext = None
+        self.handshakePool = None
+        self.handshakeWait = 1.0
+        self.handshakeLimit = None
+        self.handshakeStats = tls.HandshakeStats()
+        self._broadcasts = None
         
     def _handle_socket(self, socket, address):
         '''Handle the session of a socket.'''
+        if (self.sslContext is not None):
+            socket = self._handshake(socket, address)
+            if (socket is None):
+                return
         
         session = self.SessionClass(self, socket)
+        session.shmThreshold = self.shmThreshold
+        session.limiter = self.limiter
+        session.tracer = self.tracer
+        session.recorder = self.recorder
         logging.info('Client %s connected.' % session.name)
         
         self.clients[session] = time.time()
-        session.serve()
+        self._serve_session(session, address)
+        
+    def _handshake(self, socket, address):
+        '''Do the TLS handshake, or return None if it fails.'''
+        name = ':'.join([str(s) for s in address[:2]])
+        if (self.handshakeLimit is not None and 
+                not self.handshakeLimit.acquire()):
+            self.handshakeStats.record('shed')
+            logging.warning('Too many TLS handshakes, dropped %s.' % name)
+            return None
+        try:
+            return tls.handshake(socket, self.sslContext, True, 
+                                 stats=self.handshakeStats, 
+                                 pool=self.handshakePool,
+                                 wait=self.handshakeWait)
+        except (ssl.SSLError, EnvironmentError) as e:
+            logging.warning('TLS handshake with %s failed: %s.' % (name, e))
+            return None
+        
+    def _serve_session(self, session, address):
+        '''Serve the session until it gets idle or disconnected.'''
+        if (session.serve(self.idleTimeout)):
+            watcher = gevent.get_hub().loop.io(session.fileno(), 1)
+            self._parked[address] = (session, watcher)
+            watcher.start(self._wake_session, address)
+            return
+        self._drop_session(session)
+        
+    def _drop_session(self, session):
+        '''Abandon a session and forget about it.'''
         session.abandon()
-        del self.clients[session]
+        self.clients.pop(session, None)
+        for holders in list(self.cacheHolders.values()):
+            holders.discard(session)
         
         logging.info('Client %s disconnected.' % session.name)
         
+    def _wake_session(self, address):
+        '''Serve a parked session again, as its socket is readable.'''
+        session, watcher = self._parked.pop(address)
+        watcher.stop()
+        gevent.spawn(self._serve_session, session, address)
+        
+    def do_close(self, socket, *args):
+        '''Close the socket after the handler, unless it is parked.'''
+        if (args and args[0] in self._parked):
+            return
+        StreamServer.do_close(self, socket, *args)
+        
+    def stop(self, *args, **kwargs):
+        '''Stop the server, and disconnect parked sessions.'''
+        StreamServer.stop(self, *args, **kwargs)
+        parked = self._parked
+        self._parked = {}
+        for session, watcher in parked.values():
+            watcher.stop()
+            self._drop_session(session)
+        
     def broadcast(self, session, call):
         '''
         Send a RPC call to all clients.
@@ -117,19 +212,133 @@ class Server(StreamServer):
             logging.info('Broadcast from %s.' % (session.name))
             
         message = str(message)
+        if (self.broadcastWindow is None):
+            return self._send_broadcasts([(session, message)])[0]
         
+        # gather broadcasts until the window closes
+        if (self._broadcasts is None):
+            self._broadcasts = []
+            gevent.spawn_later(self.broadcastWindow, self._flush_broadcasts)
+        result = gevent.event.AsyncResult()
+        self._broadcasts.append((session, message, result))
+        return result.get()
+    
+    def _flush_broadcasts(self):
+        '''Send the broadcasts gathered in the window.'''
+        pending = self._broadcasts
+        self._broadcasts = None
+        try:
+            counts = self._send_broadcasts([p[:2] for p in pending])
+        except Exception as e:
+            for p in pending:
+                p[2].set_exception(e)
+            raise
+        for p, success in zip(pending, counts):
+            p[2].set(success)
+        
+    def _send_broadcasts(self, broadcasts):
+        '''
+        Send broadcast messages, each one to all clients but its sender.
+        Several messages for the same client are sent as one batch.
+        
+        :param broadcasts: List of tuple (session, message).
+        :return: Successful count of each message.
+        '''
+        counts = [0] * len(broadcasts)
         clients = list(self.clients.keys())
-        success = 0
         for c in clients:
-            if (c == session):
-                continue
             # Just broadcast, did not expect a result
             # If result, ignore it.
+            indexes = [i for i, b in enumerate(broadcasts) if b[0] != c]
+            if (not indexes):
+                continue
+            if (len(indexes) == 1):
+                frame = broadcasts[indexes[0]][1]
+            else:
+                frame = protocol.joinBatch([broadcasts[i][1] 
+                                            for i in indexes])
+            if (c.writeline(frame)):
+                for i in indexes:
+                    counts[i] += 1
+        del clients
+        return counts
+    
+    def invalidate(self, method, params=None, version=None):
+        '''
+        Tell the clients holding cached results of the method to drop 
+        them.
+        
+        :param params: Drop only the result of these params. None for all.
+        :param version: The current version. Clients having it already 
+            keep their results.
+        :return: Number of clients told.
+        '''
+        holders = self.cacheHolders.get(method, None)
+        if (not holders):
+            return 0
+        if (params is None):
+            del self.cacheHolders[method]
+        message = str(protocol.Request.encode('cache_invalidate', 
+                                              [method, params, version]))
+        success = 0
+        for c in list(holders):
             if (c.writeline(message)):
                 success += 1
-        del clients
         return success
     
+    def gather(self, method, params=None, selector=None, deadline=None,
+               quorum=None):
+        '''
+        Call a RPC method on all clients at once, and collect the results 
+        as they arrive.
+        
+        :param selector: Choose the clients to call. None to call all.
+        :type selector: callable(session) -> bool.
+        
+        :param deadline: Seconds to wait. Calls still running at the 
+            deadline are abandoned. None to wait for all.
+        :type deadline: float.
+        
+        :param quorum: Return as soon as this many calls have succeeded.
+        :type quorum: int.
+        
+        :return: Dict session -> result, or the exception raised by the 
+            call if it failed. Clients which did not answer in time are 
+            not included.
+        '''
+        sessions = [c for c in list(self.clients.keys()) 
+                    if selector is None or selector(c)]
+        done = gevent.queue.Queue()
+        def call(c):
+            try:
+                ret = c.doRequest(protocol.Request(method, params))
+                done.put((c, True, ret))
+            except Exception as e:
+                done.put((c, False, e))
+        
+        results = {}
+        succeeded = 0
+        calls = [gevent.spawn(call, c) for c in sessions]
+        timer = gevent.Timeout.start_new(deadline) if deadline else None
+        try:
+            for i in range(0, len(calls)):
+                c, ok, ret = done.get()
+                results[c] = ret
+                if (ok):
+                    succeeded += 1
+                    if (quorum is not None and succeeded >= quorum):
+                        break
+        except gevent.Timeout as t:
+            if (t is not timer):
+                raise
+            logging.info('Gather `%s` got %s of %s results at deadline.'
+                         % (method, len(results), len(calls)))
+        finally:
+            if (timer is not None):
+                timer.cancel()
+            gevent.killall(calls, block=False)
+        return results
+    
     def wrap_socket_and_handle(self, client_socket, address):
         try:
             return StreamServer.wrap_socket_and_handle(self,
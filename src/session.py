@@ -24,10 +24,13 @@
 #
 
 from __future__ import print_function, unicode_literals
-import protocol
+import protocol, sharedmem, pending, tracing
 
-import socket, logging
-import gevent.event, gevent.coros
+import socket, logging, time, os
+import gevent, gevent.socket
+
+# Bytes to read from the socket at a time.
+READ_SIZE = 65536
 
 class Session(protocol.Dispatcher):
     '''
@@ -48,13 +51,30 @@ class Session(protocol.Dispatcher):
         self.name = ':'.join([str(s) for s in self.peerName[:2]])
         self._disp = self
         self._sck = socket
-        self._fp = socket.makefile('r')
-        self._lock = gevent.coros.Semaphore()
-        self._requests = {}     # request queue
-        self._requestId = 1     # manage request id
+        # Structures below are allocated when first needed, and dropped 
+        # by release when the session goes idle.
+        # Bytes read and not taken yet, split into lines. The last one is
+        # not complete yet.
+        self._buf = None
+        self._pos = 0           # next line to take from _buf
+        self._requests = None   # request queue, pending.PendingTable
         self.requestTimeout = None # default request timeout
+        # Messages at least this long go through shared memory if the
+        # remote side is on the same host. None to disable. Messages the
+        # remote side puts into shared memory are accepted anyway.
+        self.shmThreshold = None
+        self.shmDirectory = sharedmem.DEFAULT_DIRECTORY
+        self.isLocal = sharedmem.is_local_peer(socket)
+        self._segments = None   # request id -> segment owned by us
+        self._handedOff = None  # segments for the remote side to free
+        self.limiter = None     # limiter.AdaptiveLimiter for requests
+        self.cache = None       # cache.ResultCache for call results
+        self._cacheKeys = None  # request id -> cache key
+        self.tracer = None      # tracing.Tracer for requests and calls
+        self.recorder = None    # capture.Recorder of messages
+        self._received = None   # when the last message was read
         
-    def writeline(self, msg):
+    def writeline(self, msg, requestId=None, responseId=None):
         '''
         Send a line of message to the socket.
         Nothing will be returned, but if the remote socket has closed, 
@@ -62,16 +82,99 @@ class Session(protocol.Dispatcher):
         
         :param msg: Message body.
         :type msg: UTF-8 string.
+        
+        :param requestId: If the message is a request, its id. A request 
+            put into shared memory is freed when its response arrives.
+        :type requestId: int.
+        
+        :param responseId: If the message is a response, its id.
         '''
         if (self._sck is None):
             return False
         ret = False
+        if (self.recorder is not None):
+            self.recorder.record(self, 'o', msg)
         try:
-            self._sck.sendall(msg + '\n')
+            if (self.shmThreshold is not None and self.isLocal and
+                    len(msg) >= self.shmThreshold):
+                msg = self._write_segment(msg, requestId, responseId)
+            if (not isinstance(msg, bytes)):
+                msg = msg.encode('utf-8')
+            self._sck.sendall(msg + b'\n')
             ret = True
         except socket.error:
             self._disconnected()
         return ret
+    
+    def _write_segment(self, msg, requestId, responseId):
+        '''
+        Put the message into shared memory and return the descriptor.
+        If the segment cannot be created, the message is sent as it is.
+        '''
+        try:
+            path = sharedmem.write_segment(msg, self.shmDirectory)
+        except EnvironmentError:
+            logging.exception('Cannot create shared memory segment.')
+            return msg
+        keep = requestId is not None
+        if (keep):
+            if (self._segments is None):
+                self._segments = {}
+            self._segments[requestId] = path
+        else:
+            # the remote side frees it, unless it disconnects first
+            if (self._handedOff is None):
+                self._handedOff = set()
+            elif (len(self._handedOff) >= 64):
+                self._prune_handed_off()
+            self._handedOff.add(path)
+        return sharedmem.make_descriptor(path, len(msg), keep, 
+                                         requestId if keep else responseId)
+    
+    def _read_segment(self, msg):
+        '''
+        Map the segment named by a descriptor line.
+        
+        :return: The message, or None if the descriptor is malformed. If 
+            the segment cannot be mapped, the message is answered or 
+            failed by its id, and an empty string returned.
+        '''
+        desc = None
+        if (self.isLocal):
+            desc = sharedmem.parse_descriptor(msg, self.shmDirectory)
+        if (desc is None):
+            return None
+        path, size, keep, msgId = desc
+        try:
+            return sharedmem.read_segment(path, size, not keep)
+        except (EnvironmentError, ValueError):
+            logging.warning('Cannot map shared memory segment %s.' % path)
+        if (msgId is None):
+            pass
+        elif (keep):
+            # a request of the remote side
+            self.writeline(protocol.Response.encode(
+                    None, protocol.SERVER_ERROR, msgId))
+        elif (self._requests is not None):
+            # the response to a request of ours
+            ev = self._requests.pop(msgId)
+            if (ev is not None):
+                ev.set_exception(protocol.Fault(*protocol.FAULT_SERVER_ERROR))
+        return b''
+        
+    def _free_segment(self, requestId):
+        '''Free the segment of a request which has got its response.'''
+        if (not self._segments):
+            return
+        path = self._segments.pop(requestId, None)
+        if (path is not None):
+            sharedmem.free_segment(path)
+            
+    def _prune_handed_off(self):
+        '''Forget the segments the remote side has freed.'''
+        self._handedOff = set(p for p in self._handedOff 
+                              if os.path.exists(p))
+        return len(self._handedOff)
         
     def readline(self):
         '''
@@ -79,53 +182,192 @@ class Session(protocol.Dispatcher):
         
         If socket has been closed, an empty string will be returned.
         '''
-        if (self._fp is None):
-            return ''
-        ret = self._fp.readline()
-        if (not ret):
-            self._disconnected()
-        return ret
+        if (self._sck is None):
+            return b''
+        # every chunk received is split into lines once, and they are 
+        # taken one by one, so that the rest is not copied for each line
+        buf = self._buf
+        if (buf is not None):
+            pos = self._pos
+            if (pos < len(buf) - 1):
+                self._pos = pos + 1
+                if (pos == len(buf) - 2 and not buf[-1]):
+                    self._buf = None
+                return buf[pos] + b'\n'
+        chunks = [buf[-1]] if buf is not None else []
+        self._buf = None
+        while True:
+            try:
+                data = self._sck.recv(READ_SIZE)
+            except socket.error:
+                data = b''
+            if (not data):
+                self._disconnected()
+                return b''.join(chunks)
+            if (b'\n' not in data):
+                chunks.append(data)
+                continue
+            lines = data.split(b'\n')
+            if (chunks):
+                chunks.append(lines[0])
+                lines[0] = b''.join(chunks)
+            if (len(lines) > 2 or lines[1]):
+                self._buf = lines
+                self._pos = 1
+            return lines[0] + b'\n'
+    
+    def _pending(self):
+        '''Get the request queue.'''
+        if (self._requests is None):
+            self._requests = pending.PendingTable()
+        return self._requests
+    
+    def isIdle(self):
+        '''
+        Check whether the session holds nothing but the socket: no bytes 
+        read and not handled yet, and no requests of ours pending.
+        '''
+        if (self._buf is not None or self._requests or self._segments or 
+                self._cacheKeys or 
+                self._handedOff and self._prune_handed_off()):
+            return False
+        pending = getattr(self._sck, 'pending', None)   # SSL
+        return not (pending is not None and pending())
+    
+    def release(self):
+        '''Drop the structures allocated by the session, if idle.'''
+        if (not self.isIdle()):
+            return False
+        self._requests = self._segments = self._cacheKeys = None
+        self._handedOff = None
+        return True
+    
+    def fileno(self):
+        return self._sck.fileno()
     
     def _disconnected(self):
         '''Callback when the socket has been disconnected.'''
         # unset all objects
-        if (self._fp is not None):
-            self._fp.close()    # TODO: test if .close blocks!
-            self._fp = None
+        self._buf = None
         if (self._sck is not None):
             self._sck.close()
             self._sck = None
         # abandon all request
-        events = {}
-        events.update(self._requests)
-        self._requests.clear()
-        for e in events.itervalues():
-            e.set_exception(socket.error('Connection closed.'))
+        if (self._requests is not None):
+            self._requests.failAll(socket.error('Connection closed.'))
+        # free the segments nobody is going to read
+        for path in list((self._segments or {}).values()) + list(
+                self._handedOff or ()):
+            if (os.path.exists(path)):
+                sharedmem.free_segment(path)
+        self._segments = self._handedOff = None
             
     def abandon(self):
         '''Abandon the session.'''
         #self._sck.close()
         self._disconnected()
         
-    def serve(self):
-        '''Start socket messge loop.'''
+    def serve(self, idleTimeout=None):
+        '''
+        Start socket messge loop.
+        
+        :param idleTimeout: If nothing arrives for this many seconds while
+            the session is idle, release it and return True, so that the 
+            caller may park the socket until it gets readable again. 
+            None to serve until disconnected.
+        :type idleTimeout: float.
+        '''
         while self._sck is not None:
+            if (idleTimeout is not None and self.isIdle()):
+                try:
+                    gevent.socket.wait_read(self._sck.fileno(), 
+                                            idleTimeout)
+                except socket.timeout:
+                    if (self._sck is not None and self.release()):
+                        return True
+                    continue
             msg = self.readline()
             if (not msg):
                 return
+            if (self.tracer is not None):
+                self._received = time.time()
             msg = msg.strip()
-            obj = protocol.parseJson(msg)
-            if (isinstance(obj, tuple)):
-                logging.debug('Got bad message from %s.' % self.name)
-                self._send_response(protocol.Response(None, obj[0], obj[1]))
-            elif (isinstance(obj, protocol.Response)):
-                logging.debug('Got response from %s.' % self.name)
+            if (msg.startswith(sharedmem.DESCRIPTOR_PREFIX)):
+                desc, msg = msg, self._read_segment(msg)
+                if (msg is None):
+                    self._got_badmessage(desc)
+                if (not msg):
+                    continue
+            if (self.recorder is not None):
+                self.recorder.record(self, 'i', msg)
+            self._got_message(msg)
+    
+    def _got_message(self, msg):
+        '''Handle a message received from the remote side.'''
+        obj = protocol.parseJson(msg)
+        if (isinstance(obj, tuple)):
+            logging.debug('Got bad message from %s.' % self.name)
+            self.writeline(protocol.Response.encode(None, *obj))
+        elif (isinstance(obj, protocol.Response)):
+            logging.debug('Got response from %s.' % self.name)
+            self._got_response(obj)
+        elif (isinstance(obj, protocol.Request)):
+            logging.debug('Handle request from %s.' % self.name)
+            if (self.limiter is not None and not self.limiter.acquire()):
+                if (obj.id is not None):
+                    self.writeline(protocol.Response.encode(
+                            None, protocol.SERVER_BUSY, obj.id))
+                return
+            if (self.tracer is not None):
+                gevent.spawn(self._serve_traced, obj, self._received, 
+                             time.time())
+            else:
+                gevent.spawn(self._serve_request, obj)
+        elif (isinstance(obj, list)):
+            logging.debug('Got batch from %s.' % self.name)
+            self._got_batch(obj)
+        else:
+            self._got_badmessage(msg)
+    
+    def _got_batch(self, batch):
+        '''
+        Handle a batch of messages.
+        
+        Responses are taken at once. Requests are served one after 
+        another in a single greenlet, and their responses are sent back 
+        as one batch. Requests without id get no response.
+        '''
+        requests = []
+        errors = []
+        for obj in batch:
+            if (isinstance(obj, protocol.Response)):
                 self._got_response(obj)
             elif (isinstance(obj, protocol.Request)):
-                logging.debug('Handle request from %s.' % self.name)
-                gevent.spawn(self._serve_request, obj)
-            else:
-                self._got_badmessage(msg)
+                if (self.limiter is not None and 
+                        not self.limiter.acquire()):
+                    if (obj.id is not None):
+                        errors.append(protocol.Response.encode(
+                                None, protocol.SERVER_BUSY, obj.id))
+                    continue
+                requests.append(obj)
+            elif (isinstance(obj, tuple) and obj[1] is not None):
+                errors.append(protocol.Response.encode(None, *obj))
+        if (requests or errors):
+            gevent.spawn(self._serve_batch, requests, errors)
+            
+    def _serve_batch(self, requests, responses):
+        '''Serve the requests in a batch.'''
+        for request in requests:
+            result = self._dispatch(request)
+            if (request.id is None):
+                continue
+            try:
+                responses.append(result.toJSON())
+            except protocol.Fault as fault:
+                responses.append(protocol.Response.encode(None, fault, 
+                                                          request.id))
+        if (responses):
+            self.writeline(protocol.joinBatch(responses))
                 
     def _got_badmessage(self, msg):
         '''Called while socket received a bad message.'''
@@ -135,59 +377,133 @@ class Session(protocol.Dispatcher):
         '''Send response to the remote side.'''
         return self.writeline(response.toJSON())
     
-    def _send_request(self, s, asyncResult):
-        if (not self.writeline(s)):
+    def _send_request(self, s, asyncResult, requestId=None):
+        if (not self.writeline(s, requestId)):
             asyncResult.set_exception(socket.error('Connection closed.'))
 
     def _serve_request(self, request):
         '''Serve when get request from remote side.'''
-        result = self._disp.dispatch(request)
+        result = self._dispatch(request)
+        result.id = request.id
+        try:
+            msg = result.toJSON()
+        except protocol.Fault as fault:
+            # the result cannot be encoded, tell the caller at least
+            msg = protocol.Response.encode(None, fault, request.id)
+        self.writeline(msg, responseId=request.id)
+        
+    def _serve_traced(self, request, received, parsed):
+        '''Serve the request, and record the spans of its phases.'''
+        context = request.trace or self.tracer.sample()
+        if (not tracing.is_sampled(context)):
+            # calls made by the method are not sampled either
+            tracing.set_current(context)
+            try:
+                return self._serve_request(request)
+            finally:
+                tracing.set_current(None)
+        record = self.tracer.record
+        attrs = {'rpc.method': request.method, 'net.peer.name': self.name}
+        started = time.time()
+        record(context, 'parse', received, parsed, **attrs)
+        record(context, 'queue', parsed, started, **attrs)
+        # calls made by the method are children of the dispatch span
+        spanId = tracing.new_span_id()
+        tracing.set_current({'trace_id': context['trace_id'], 
+                             'span_id': spanId, 'sampled': True})
+        try:
+            result = self._dispatch(request)
+        finally:
+            tracing.set_current(None)
+        dispatched = time.time()
+        record(context, 'dispatch', started, dispatched, spanId, **attrs)
         result.id = request.id
-        self.writeline(result.toJSON())
+        try:
+            msg = result.toJSON()
+        except protocol.Fault as fault:
+            msg = protocol.Response.encode(None, fault, request.id)
+        encoded = time.time()
+        record(context, 'encode', dispatched, encoded, **attrs)
+        self.writeline(msg, responseId=request.id)
+        record(context, 'write', encoded, time.time(), **attrs)
+        
+    def _dispatch(self, request):
+        '''Dispatch the request, and report its latency to the limiter.'''
+        if (self.limiter is None):
+            return self._disp.dispatch(request)
+        start = time.time()
+        try:
+            return self._disp.dispatch(request)
+        finally:
+            self.limiter.release(request.method, time.time() - start)
         
     def _got_response(self, response):
         '''Parse the response from remote side.'''
         rId = response.id
-        ev = self._requests.pop(rId, None)
+        # the request has been read, even if the call has given up
+        self._free_segment(rId)
+        if (self._requests is None):
+            return
+        ev = self._requests.pop(rId)
         if (ev is not None):
             if (response.error is not None):
                 ev.set_exception(response.error)
             else:
+                if (response.cache is not None and self.cache is not None
+                        and self._cacheKeys and rId in self._cacheKeys):
+                    self.cache.put(self._cacheKeys[rId], response.result,
+                                   response.cache.get('version', None),
+                                   response.cache.get('ttl', None))
                 ev.set(response.result)
     
     def _nextRquestId(self):
         '''get next available job id.'''
-        self._lock.acquire()
-        ret = self._requestId
-        self._requestId += 1
-        if (self._requestId == 0xffffffff):
-            self._requestId = 1
-        self._lock.release()
-        return ret
+        return self._pending().nextId()
     
-    def doRequest(self, request, timeout=None):
+    def doRequest(self, request, timeout=None, cacheKey=None):
         '''
         Emit a request.
         
-        Raise socket.error if the connection has been closed.
+        Raise socket.error if the connection has been closed, and 
+        gevent.Timeout if no response arrives within timeout seconds.
+        
+        :param cacheKey: If the result is cacheable, store it in the 
+            session cache with this key.
         '''
-        # assign a job id.
-        rId = self._nextRquestId()
+        # assign a job id, with the timeout on the shared timer wheel
+        rId, result = self._pending().add(timeout)
         request.id = rId
-        # serialize request
-        s = request.toJSON()
-        # init async call
-        result = gevent.event.AsyncResult()
-        self._requests[rId] = result
-        # emit job
-        gevent.spawn(self._send_request, s, result)
-        # wait for result & delete job
+        if (cacheKey is not None):
+            if (self._cacheKeys is None):
+                self._cacheKeys = {}
+            self._cacheKeys[rId] = cacheKey
+        # propagate the trace of the current greenlet, or start one
+        context = tracing.current()
+        if (context is None and self.tracer is not None):
+            context = self.tracer.sample()
+        if (context is not None):
+            spanId = tracing.new_span_id()
+            sampled = tracing.is_sampled(context)
+            request.trace = {'trace_id': context['trace_id'], 
+                             'span_id': spanId, 'sampled': sampled}
+            started = time.time()
         try:
-            ret = result.get(timeout=timeout)
-            return ret
-        except:
-            self._requests.pop(rId, None)
-            raise
+            # serialize request
+            s = request.toJSON()
+            # emit job
+            gevent.spawn(self._send_request, s, result, rId)
+            # wait for result
+            return result.get()
+        finally:
+            # delete job
+            self._requests.pop(rId)
+            if (self._cacheKeys):
+                self._cacheKeys.pop(rId, None)
+            if (context is not None and sampled and 
+                    self.tracer is not None):
+                self.tracer.record(context, 'call', started, time.time(),
+                                   spanId, **{'rpc.method': request.method,
+                                              'net.peer.name': self.name})
         
     def call(self, method, *args, **kwargs):
         '''
@@ -198,6 +514,8 @@ class Session(protocol.Dispatcher):
         TypeError.
         
         Raise socket.error if the connection has been closed.
+        
+        The result is taken from the session cache if possible.
         '''
         if (len(args) > 0 and len(kwargs) > 0):
             raise TypeError('JSON RPC requires only one of the list '
@@ -205,5 +523,12 @@ class Session(protocol.Dispatcher):
         params = (args if len(args) > 0
                        else kwargs if len(kwargs) > 0
                                    else None)
+        key = None
+        if (self.cache is not None):
+            key = self.cache.key(method, params)
+            hit, ret = self.cache.get(key)
+            if (hit):
+                return ret
         timeout = self.requestTimeout
-        return self.doRequest(protocol.Request(method, params), timeout)
+        return self.doRequest(protocol.Request(method, params), timeout, 
+                              key)
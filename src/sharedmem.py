@@ -0,0 +1,140 @@
+# -*- encoding: utf-8 -*-
+# $File: sharedmem.py
+#
+# Copyright (C) 2012 the pynojo development team <see AUTHORS file>
+#
+# This file is part of pynojo
+#
+# pynojo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynojo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynojo.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function, unicode_literals
+import os, mmap, socket, tempfile, logging
+
+# Large payloads between peers on the same host do not have to go
+# through the socket. The sender writes the message into a segment
+# under /dev/shm (a tmpfs, so the pages never touch the disk), and only
+# sends a small descriptor line:
+#
+#     @shm <size> <keep> <id> <path>
+#
+# The descriptor is not valid JSON, so a single character check tells it
+# apart from ordinary messages. If keep is 1, the segment holds a request
+# and the sender owns it: it is freed when the response arrives, or the
+# connection closes. Otherwise the receiver frees it right after mapping.
+# The id is that of the request (keep 1) or response (keep 0) in the
+# segment, or - if it is not an integer, so that the receiver can answer
+# the message even when the segment cannot be mapped. Receivers on the same host always accept
+# descriptors, so that a peer which does not send through shared memory
+# itself still gets the messages, and frees their segments.
+#
+# Lines are byte strings as read from the socket, and so is the prefix.
+DESCRIPTOR_PREFIX = b'@shm '
+DEFAULT_DIRECTORY = ('/dev/shm' if os.path.isdir('/dev/shm')
+                                else tempfile.gettempdir())
+
+def is_local_peer(sck):
+    '''Check whether the remote side of the socket is on this host.'''
+    try:
+        if (sck.family == getattr(socket, 'AF_UNIX', None)):
+            return True
+        peer = sck.getpeername()[0]
+        local = sck.getsockname()[0]
+    except (socket.error, AttributeError):
+        return False
+    return (peer == local or peer.startswith('127.')
+                or peer in ('::1', '::ffff:127.0.0.1'))
+
+def write_segment(data, directory=DEFAULT_DIRECTORY):
+    '''
+    Write message into a new shared memory segment.
+
+    :return: Path of the segment.
+    '''
+    if (not isinstance(data, bytes)):
+        data = data.encode('utf-8')
+    fd, path = tempfile.mkstemp(prefix='jsonrpc-', dir=directory)
+    try:
+        os.ftruncate(fd, len(data))
+        mm = mmap.mmap(fd, len(data))
+        try:
+            mm[:] = data
+        finally:
+            mm.close()
+    except:
+        os.unlink(path)
+        raise
+    finally:
+        os.close(fd)
+    return path
+
+def read_segment(path, size, free=True):
+    '''
+    Map a shared memory segment and return its content.
+
+    The segment is unlinked right after mapping if free is True, so the
+    pages are released as soon as the mapping is closed.
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        mm = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+        if (free):
+            free_segment(path)
+    try:
+        # The JSON decoder needs a string, so this is the only copy.
+        return mm[:]
+    finally:
+        mm.close()
+
+def free_segment(path):
+    '''Release a shared memory segment.'''
+    try:
+        os.unlink(path)
+    except OSError:
+        logging.debug('Shared memory segment %s already freed.' % path)
+
+def make_descriptor(path, size, keep, msgId=None):
+    '''Make the descriptor line for a segment.'''
+    if (not isinstance(msgId, int) or isinstance(msgId, bool)):
+        msgId = '-'
+    return DESCRIPTOR_PREFIX + ('%d %d %s %s' % (size, 1 if keep else 0, 
+                                                 msgId, path)
+                               ).encode('utf-8')
+
+def parse_descriptor(msg, directory=DEFAULT_DIRECTORY):
+    '''
+    Parse the descriptor line.
+
+    Segments outside the given directory are refused, so that the remote
+    side cannot make us read or unlink arbitrary files.
+
+    :param msg: Descriptor line.
+    :type msg: bytes.
+
+    :return: Tuple (path, size, keep, id), or None if the line is 
+        malformed. The id is None if the sender did not give one.
+    '''
+    try:
+        size, keep, msgId, path = msg[len(DESCRIPTOR_PREFIX):].decode(
+                'utf-8').split(' ', 3)
+        size = int(size)
+        msgId = None if msgId == '-' else int(msgId)
+    except ValueError:
+        return None
+    if (os.path.dirname(path) != directory or size <= 0 or
+            not os.path.basename(path).startswith('jsonrpc-')):
+        return None
+    return (path, size, keep == '1', msgId)
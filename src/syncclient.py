@@ -0,0 +1,163 @@
+# -*- encoding: utf-8 -*-
+# $File: syncclient.py
+#
+# Copyright (C) 2012 the pynojo development team <see AUTHORS file>
+#
+# This file is part of pynojo
+#
+# pynojo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynojo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynojo.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function, unicode_literals
+import socket
+
+import protocol
+
+# Blocking client
+#
+# For scripts which make a few calls and exit, client.Client costs more
+# than the calls: importing gevent, and a greenlet serving the session.
+# SyncClient needs nothing but the standard library. It serves nothing
+# either: requests from the server are answered with PROC_NOT_FOUND, and
+# notifications (broadcasts, cache invalidation) are dropped.
+#
+# Pipelining: calls are all sent before any response is read, so that a
+# batch of calls costs one round trip. Unlike a JSON RPC batch, the
+# server serves them concurrently, and answers them as they complete.
+#
+
+class SyncClient(object):
+    '''Blocking RPC client.'''
+    def __init__(self, address, timeout=None, sslContext=None,
+                 serverHostname=None):
+        '''
+        Connect to a server.
+
+        :param timeout: Seconds to wait for the server. None to wait
+            forever.
+        :type timeout: float.
+
+        :param sslContext: TLS configuration, see tls.client_context.
+        :type sslContext: ssl.SSLContext.
+        '''
+        self._sck = socket.create_connection(address, timeout)
+        if (sslContext is not None):
+            self._sck = sslContext.wrap_socket(
+                    self._sck, server_hostname=serverHostname)
+        self._fp = self._sck.makefile('rb')
+        self._nextId = 1
+        self._responses = {}    # id -> Response read ahead
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''Disconnect from the server.'''
+        if (self._sck is not None):
+            self._fp.close()
+            self._sck.close()
+            self._sck = self._fp = None
+
+    def call(self, method, *args, **kwargs):
+        '''
+        Call remote RPC method.
+
+        JSON RPC requires only one of the list params or dict params,
+        so pass *args and **kwargs at the same time will cause a
+        TypeError.
+
+        Raise Fault if the call fails, and socket.error if the
+        connection has been closed.
+        '''
+        if (len(args) > 0 and len(kwargs) > 0):
+            raise TypeError('JSON RPC requires only one of the list '
+                            'params or dict params.')
+        params = (args if len(args) > 0
+                       else kwargs if len(kwargs) > 0
+                                   else None)
+        ret = self.pipeline([(method, params)])[0]
+        if (isinstance(ret, protocol.Fault)):
+            raise ret
+        return ret
+
+    def pipeline(self, calls):
+        '''
+        Send all calls, then wait for their results.
+
+        :param calls: Tuple (method, params) of each call.
+        :type calls: list.
+
+        :return: Result of each call, or the Fault if it failed.
+        '''
+        ids = []
+        lines = []
+        for method, params in calls:
+            ids.append(self._nextId)
+            lines.append(self._encode(protocol.Request(method, params,
+                                                       self._nextId)))
+            self._nextId += 1
+        self._send(b''.join(lines))
+        results = []
+        for rId in ids:
+            response = self._responses.pop(rId, None)
+            while response is None:
+                self._read()
+                response = self._responses.pop(rId, None)
+            results.append(response.error if response.error is not None
+                                          else response.result)
+        return results
+
+    @staticmethod
+    def _encode(message):
+        s = message.toJSON()
+        if (not isinstance(s, bytes)):
+            s = s.encode('utf-8')
+        return s + b'\n'
+
+    def _send(self, data):
+        if (self._sck is None):
+            raise socket.error('Connection closed.')
+        self._sck.sendall(data)
+
+    def _read(self):
+        '''Read a message, and keep the responses in it.'''
+        if (self._fp is None):
+            raise socket.error('Connection closed.')
+        line = self._fp.readline()
+        if (not line):
+            self.close()
+            raise socket.error('Connection closed.')
+        line = line.strip()
+        if (line.startswith(b'@shm ')):
+            line = self._read_segment(line)
+        obj = protocol.parseJson(line)
+        for o in (obj if isinstance(obj, list) else [obj]):
+            if (isinstance(o, protocol.Response)):
+                self._responses[o.id] = o
+            elif (isinstance(o, protocol.Request) and o.id is not None):
+                self._send(self._encode(protocol.Response(
+                        None, protocol.PROC_NOT_FOUND, o.id)))
+
+    @staticmethod
+    def _read_segment(line):
+        '''Map a message the server put into shared memory.'''
+        import sharedmem
+        desc = sharedmem.parse_descriptor(line)
+        if (desc is None):
+            return line
+        path, size, keep, msgId = desc
+        return sharedmem.read_segment(path, size, not keep)
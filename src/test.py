@@ -24,14 +24,23 @@
 #
 
 from __future__ import print_function, unicode_literals
-import unittest, time, sys, ssl
+import unittest, time, sys, ssl, socket
 
 import server, client, protocol
-import gevent
+import gevent, gevent.socket
 
 # Session
 class ServerSession(server.ServerSession):
-    pass
+    @protocol.expose
+    def sleep(self, seconds):
+        gevent.sleep(seconds)
+        return seconds
+    
+    settings = {}
+    @protocol.expose
+    def setting(self, name):
+        value = self.settings.get(name, None)
+        return protocol.Cacheable(value, version=value)
 
 # Test Case 
 SERVER = server.Server(('127.0.0.1', 9999), ServerSession)
@@ -78,8 +87,546 @@ class Test(unittest.TestCase):
                             % (time.time() - start_time))
         sys.stdout.flush()
         return
+
+    def test_tls_handshake(self):
+        '''Handshake in threads with resumption, and limit the rate.'''
+        import tls
+        # the bundled keys are 1024 bits, and have expired
+        svr = server.Server(('127.0.0.1', 9987), ServerSession)
+        svr.sslContext = tls.server_context(
+                'certs/keys/pynojo-center-control.crt',
+                'certs/keys/pynojo-center-control.key',
+                ciphers='DEFAULT:@SECLEVEL=0')
+        svr.handshakeLimit = tls.RateLimit(1, burst=3)
+        gevent.spawn(svr.serve_forever)
+        gevent.sleep(0.1)
+        context = tls.client_context(verify=False,
+                                     ciphers='DEFAULT:@SECLEVEL=0')
+        clients = []
+        for i in range(0, 3):
+            clt = client.Client(('127.0.0.1', 9987), sslContext=context)
+            gevent.spawn(clt.serve)
+            self.assertTrue(clt.call('echo', 'hi %d' % i) == 'hi %d' % i,
+                            'Client cannot call server.echo via TLS.')
+            clients.append(clt)
+        stats = svr.handshakeStats
+        self.assertTrue(stats.counts['full'] + stats.counts['resumed'] == 3)
+        if (hasattr(ssl, 'SSLSession')):
+            self.assertTrue(stats.counts['resumed'] == 2,
+                            'Sessions not resumed.')
+        # over the rate limit
+        self.assertRaises((ssl.SSLError, socket.error), client.Client,
+                          ('127.0.0.1', 9987), sslContext=context)
+        self.assertTrue(stats.counts['shed'] == 1)
+        self.assertTrue(tls.clientStats.counts['failed'] >= 1)
+        # silent connections take no thread, and time out on the hub
+        svr.handshakeLimit = None
+        svr.handshakeWait = 0.3
+        silent = [gevent.socket.create_connection(('127.0.0.1', 9987))
+                  for i in range(0, 10)]
+        gevent.sleep(0.1)
+        start_time = time.time()
+        clt = client.Client(('127.0.0.1', 9987), sslContext=context)
+        gevent.spawn(clt.serve)
+        self.assertTrue(clt.call('echo', 'hi') == 'hi')
+        self.assertTrue(time.time() - start_time < 0.2, 
+                        'Handshake held up by silent connections.')
+        clients.append(clt)
+        gevent.sleep(0.4)
+        self.assertTrue(stats.counts['failed'] == 10)
+        for sck in silent:
+            sck.close()
+        # host names are checked along with certificates
+        self.assertRaises(ValueError, client.Client, ('127.0.0.1', 9987),
+                          sslContext=tls.client_context())
+        for clt in clients:
+            clt.disconnect()
+        svr.stop()
+
+    def test_shared_memory(self):
+        '''Transport large messages via shared memory on the same host.'''
+        import os, sharedmem
+        msg = 'x' * (4 << 20)
+        before = set(os.listdir(sharedmem.DEFAULT_DIRECTORY))
+        written = []
+        write_segment = sharedmem.write_segment
+        def counting_write_segment(*args):
+            written.append(write_segment(*args))
+            return written[-1]
+        gevent.sleep(0.1)   # let the server start listening
+        self.server.shmThreshold = 1024
+        sharedmem.write_segment = counting_write_segment
+        try:
+            clt = client.Client(('127.0.0.1', 9999))
+            clt.setShmThreshold(1024)
+            gevent.spawn(clt.serve)
+            for i in range(0, 3):
+                self.assertTrue(clt.call('echo', msg) == msg,
+                                'Client cannot echo via shared memory.')
+            self.assertTrue(len(written) == 6, 'Shared memory not used.')
+            self.assertTrue(clt.call('echo', 'short') == 'short')
+            self.assertTrue(len(written) == 6)
+            clt.disconnect()
+            # a client which does not send through shared memory itself
+            # still takes the responses the server puts there
+            clt = client.Client(('127.0.0.1', 9999))
+            clt.setRequestTimeout(5)
+            gevent.spawn(clt.serve)
+            self.assertTrue(clt.call('echo', 'x' * 4096) == 'x' * 4096)
+            self.assertTrue(len(written) == 7)
+            clt.disconnect()
+        finally:
+            sharedmem.write_segment = write_segment
+            self.server.shmThreshold = None
+        gevent.sleep(0.1)
+        after = set(os.listdir(sharedmem.DEFAULT_DIRECTORY))
+        self.assertTrue(after <= before, 'Leaked segments %s.' 
+                        % list(after - before))
+        
+    def test_shared_memory_lifetime(self):
+        '''Keep segments until they are read, and free them on close.'''
+        import os, session, sharedmem
+        class EchoSession(session.Session):
+            @protocol.expose
+            def echo(self, message):
+                return message
+        before = set(os.listdir(sharedmem.DEFAULT_DIRECTORY))
+        a, b = gevent.socket.socketpair()
+        caller, callee = EchoSession(a), EchoSession(b)
+        caller.shmThreshold = callee.shmThreshold = 1024
+        caller.requestTimeout = 0.1
+        gevent.spawn(caller.serve)
+        # calls giving up before the remote side reads them
+        for i in range(0, 2):
+            self.assertRaises(gevent.Timeout, caller.call, 'echo', 'x' * 4096)
+        self.assertTrue(len(caller._segments) == 2, 'Segments freed early.')
+        lost = list(caller._segments.values())[1]
+        os.unlink(lost)
+        # one is served, and the lost one answered with an error
+        replies = []
+        caller._got_response = lambda r: (
+                replies.append(r), EchoSession._got_response(caller, r))
+        callee_serving = gevent.spawn(callee.serve)
+        gevent.sleep(0.1)
+        self.assertTrue(sorted(r.error is None for r in replies) 
+                        == [False, True], 'Got %r.' % replies)
+        self.assertTrue(not caller._segments and callee._sck is not None)
+        caller.requestTimeout = 5
+        self.assertTrue(caller.call('echo', 'y' * 4096) == 'y' * 4096)
+        # a push the remote side never reads is freed on disconnect
+        callee_serving.kill()
+        caller.abandon()
+        callee.writeline(protocol.Request('echo', ['z' * 4096]).toJSON())
+        callee.abandon()
+        after = set(os.listdir(sharedmem.DEFAULT_DIRECTORY))
+        self.assertTrue(after <= before, 'Leaked segments %s.' 
+                        % list(after - before))
+        
+    def test_readline(self):
+        '''Split pipelined frames sent in odd pieces into lines.'''
+        import session
+        a, b = gevent.socket.socketpair()
+        s = session.Session(b)
+        frames = [('{"id":%d,"params":["%s"]}\n' % (i, 'x' * (i % 300)))
+                  .encode('utf-8') for i in range(0, 3000)] + [b'\n']
+        data = b''.join(frames) + b'{"id":'
+        def send():
+            for i in range(0, len(data), 7777):
+                a.sendall(data[i:i + 7777])
+                gevent.sleep(0)
+            a.close()
+        gevent.spawn(send)
+        lines = []
+        while True:
+            line = s.readline()
+            if (not line):
+                break
+            lines.append(line)
+        self.assertTrue(lines == frames + [b'{"id":'], 'Lines mangled.')
+        
+    def test_non_ascii_frame(self):
+        '''Answer a frame holding raw UTF-8, as JSON allows.'''
+        gevent.sleep(0.1)   # let the server start listening
+        sck = gevent.socket.create_connection(('127.0.0.1', 9999))
+        sck.sendall('{"id":1,"method":"echo","params":["café"]}\n'
+                    .encode('utf-8'))
+        ret = protocol.parseJson(sck.makefile('rb').readline())
+        self.assertTrue(isinstance(ret, protocol.Response) and 
+                        ret.result == 'café', 'Got %r.' % ret)
+        sck.close()
+        
+    def test_extension_types(self):
+        '''Echo binary strings and NumPy arrays through extension types.'''
+        gevent.sleep(0.1)   # let the server start listening
+        clt = client.Client(('127.0.0.1', 9999))
+        gevent.spawn(clt.serve)
+        blob = bytearray(range(0, 256))
+        self.assertTrue(clt.call('echo', blob) == blob,
+                        'Client cannot echo binary string.')
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if (numpy is not None):
+            a = numpy.arange(12, dtype='<f8').reshape((3, 4))
+            ret = clt.call('echo', {'a': [a, a.T]})['a']
+            self.assertTrue(ret[0].dtype == a.dtype and 
+                            (ret[0] == a).all() and (ret[1] == a.T).all(),
+                            'Client cannot echo NumPy array.')
+            ret[0][0, 0] = 1.0      # arrays received are writable
+        clt.disconnect()
+        
+    def test_json_backends(self):
+        '''Select JSON backends, and parse messages with each of them.'''
+        import os
+        loaded = protocol.load_backend()
+        env = os.environ.get('JSON_RPC_BACKEND', None)
+        try:
+            # the environment names the backend, and a missing one falls
+            # back to the fastest installed
+            for name, expected in (('json', 'json'), ('nothing', loaded)):
+                protocol.json_backend = None
+                os.environ['JSON_RPC_BACKEND'] = name
+                self.assertTrue(protocol.load_backend() == expected,
+                                'Backend %s not loaded.' % name)
+            self.assertRaises(ImportError, protocol.use_backend, 'nothing')
+            for name, backend in protocol.JSON_BACKENDS:
+                try:
+                    protocol.use_backend(name)
+                except ImportError:
+                    continue
+                # byte strings as read from the socket
+                req = protocol.parseJson('{"jsonrpc":"2.0","id":1,'
+                        '"method":"echo","params":["café"]}'.encode('utf-8'))
+                self.assertTrue(isinstance(req, protocol.Request) and 
+                                req.params == ['café'], 
+                                '%s cannot parse bytes.' % name)
+                self.assertTrue(protocol.parseJson(req.toJSON()).params 
+                                == ['café'])
+                # values some JSON libraries cannot encode by themselves
+                edge = [{1: 'a', 2.5: 'b', None: 'c'}, 2 ** 70, -2 ** 64]
+                self.assertTrue(protocol.json_decode(protocol.json_encode(
+                        edge)) == [{'1': 'a', '2.5': 'b', 'null': 'c'}, 
+                                   2 ** 70, -2 ** 64],
+                        '%s encodes differently.' % name)
+                self.assertRaises(protocol.JsonEncodeError, 
+                                  protocol.json_encode, object())
+                # invalid messages
+                self.assertTrue(protocol.parseJson(b'{"id":1') is None)
+                self.assertTrue(protocol.parseJson(b'[]') is None)
+                self.assertTrue(protocol.parseJson(b'{"id":1}') is None,
+                                '%s took a response without result.' % name)
+                self.assertTrue(protocol.parseJson(
+                        b'{"id":1,"error":"failed"}') is None)
+                self.assertTrue(protocol.parseJson(
+                        b'{"id":2,"method":"echo","params":1}')
+                        == (protocol.INVALID_JSON_RPC, 2))
+                self.assertTrue(protocol.parseJson(
+                        b'[{"id":1,"result":null},{"id":1}]')[1] is None)
+                self.assertRaises(protocol.Fault, protocol.Response.fromJSON,
+                                  b'{"id":1}')
+        finally:
+            if (env is None):
+                os.environ.pop('JSON_RPC_BACKEND', None)
+            else:
+                os.environ['JSON_RPC_BACKEND'] = env
+            protocol.use_backend(loaded)
+        
+    def test_shared_faults(self):
+        '''Never let shared Fault instances escape to the callers.'''
+        self.assertRaises(AttributeError, setattr, 
+                          protocol.PROC_NOT_FOUND, 'message', 'changed')
+        self.assertTrue(protocol.PROC_NOT_FOUND.code == -32601)
+        fault = protocol.Fault(*protocol.FAULT_PROC_NOT_FOUND)
+        fault.message = 'changed'
+        for o in (protocol.Request('echo', None, 1), 
+                  protocol.Response(None, None, 1)):
+            self.assertRaises(AttributeError, setattr, o, 'extra', 1)
+            self.assertFalse(hasattr(o, '__dict__'), 'No __slots__.')
+        # errors parsed from responses are new instances
+        ret = protocol.parseJson(protocol.Response.encode(
+                error=protocol.PROC_NOT_FOUND, id=1))
+        self.assertTrue(ret.error.code == -32601 and
+                        ret.error is not protocol.PROC_NOT_FOUND)
+        gevent.sleep(0.1)   # let the server start listening
+        clt = client.Client(('127.0.0.1', 9999))
+        gevent.spawn(clt.serve)
+        for method in ('nothing', 1, ['echo']):
+            try:
+                clt.call(method, 'x')
+                self.fail('Non-exposed method %r called.' % (method, ))
+            except protocol.Fault as e:
+                self.assertTrue(e.code == -32601, 'Got %r.' % e)
+                self.assertTrue(e is not protocol.PROC_NOT_FOUND,
+                                'Shared Fault raised to the caller.')
+                e.message = 'changed'
+        self.assertTrue(protocol.PROC_NOT_FOUND.message 
+                        == 'Procedure not found.')
+        clt.disconnect()
+        
+    def test_sync_client(self):
+        '''Pipeline calls with the blocking client, which needs no gevent.'''
+        import subprocess, syncclient
+        gevent.sleep(0.1)   # let the server start listening
+        def run():
+            with syncclient.SyncClient(('127.0.0.1', 9999), 5) as clt:
+                start_time = time.time()
+                ret = clt.pipeline([('sleep', [0.2]), ('echo', ['x']),
+                                    ('sleep', [0.2]), ('nothing', None)])
+                return (clt.call('echo', 'hi'), ret,
+                        time.time() - start_time)
+        # the client blocks, so it runs in a thread while the hub serves
+        one, ret, elapsed = gevent.get_hub().threadpool.apply(run)
+        self.assertTrue(one == 'hi' and ret[:3] == [0.2, 'x', 0.2])
+        self.assertTrue(isinstance(ret[3], protocol.Fault) and
+                        ret[3].code == protocol.FAULT_PROC_NOT_FOUND[0])
+        self.assertTrue(elapsed < 0.35, 'Calls not pipelined.')
+        out = subprocess.check_output([sys.executable, '-c',
+                'import sys, syncclient; sys.stdout.write("%s %s" % '
+                '("gevent" in sys.modules, "json" in sys.modules))'])
+        self.assertTrue(out.split() == [b'False', b'False'],
+                        'Importing the client is not lazy.')
+
+    def test_capture_replay(self):
+        '''Record traffic with rotation, and replay it against a server.'''
+        import os, shutil, tempfile, capture, replay
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'traffic')
+        svr = server.Server(('127.0.0.1', 9986), ServerSession)
+        svr.recorder = capture.Recorder(path, maxBytes=2048, backups=10)
+        gevent.spawn(svr.serve_forever)
+        gevent.sleep(0.1)
+        try:
+            clients = [client.Client(('127.0.0.1', 9986)) for i in range(2)]
+            for c in clients:
+                gevent.spawn(c.serve)
+            for i in range(0, 20):
+                self.assertTrue(clients[i % 2].call('echo', i) == i)
+            self.assertTrue(clients[0].call('sleep', 0.1) == 0.1)
+            # a batch, answered by one frame too
+            sck = gevent.socket.create_connection(('127.0.0.1', 9986))
+            sck.sendall(b'[{"id":"b1","method":"echo","params":[1]},'
+                        b'{"id":"b2","method":"sleep","params":[0.1]},'
+                        b'{"id":null,"method":"echo","params":[2]}]\n')
+            self.assertTrue(len(protocol.parseJson(
+                    sck.makefile('rb').readline())) == 2)
+            sck.close()
+            for c in clients:
+                c.disconnect()
+            svr.recorder.close()
+            paths = capture.capture_files(path)
+            self.assertTrue(len(paths) > 1, 'Capture not rotated.')
+            frames = list(capture.read_capture(paths))
+            self.assertTrue(len(frames) == 44 and
+                            [f[0] for f in frames] ==
+                            sorted(f[0] for f in frames))
+            # buffered lines are flushed by a timer
+            recorder = capture.Recorder(path + '-flush', flushInterval=0.1)
+            recorder.record(clients[0].session, 'o', b'{}')
+            self.assertTrue(os.path.getsize(path + '-flush') == 0)
+            gevent.sleep(0.2)
+            self.assertTrue(os.path.getsize(path + '-flush') > 0,
+                            'Capture not flushed.')
+            recorder.close()
+            # replay against the shared server, at 2x and at max speed
+            for speed in (2.0, None):
+                start_time = time.time()
+                results = replay.replay(('127.0.0.1', 9999), paths, speed)
+                self.assertTrue(len(results) == 23 and 
+                                None not in [r[1] for r in results],
+                                'Batch not replayed.')
+                summary = replay.summarize(results)
+                self.assertTrue(summary['echo']['count'] == 21 and
+                                summary['sleep']['count'] == 2 and
+                                summary['sleep']['replayed_p50'] >= 0.1 and
+                                summary['sleep']['recorded_p50'] >= 0.1)
+            self.assertTrue(time.time() - start_time < 0.5)
+        finally:
+            svr.stop()
+            shutil.rmtree(directory)
+
+    def test_request_timeout(self):
+        '''Time out requests, and fail pending ones on disconnection.'''
+        gevent.sleep(0.1)   # let the server start listening
+        clt = client.Client(('127.0.0.1', 9999))
+        gevent.spawn(clt.serve)
+        session = clt.session
+        clt.setRequestTimeout(0.2)
+        start_time = time.time()
+        self.assertRaises(gevent.Timeout, clt.call, 'sleep', 1)
+        self.assertTrue(time.time() - start_time < 0.5, 'Timeout too late.')
+        self.assertTrue(clt.call('sleep', 0.05) == 0.05)
+        self.assertTrue(len(session._requests) == 0, 'Requests leaked.')
+        clt.setRequestTimeout(None)
+        calls = [gevent.spawn(clt.call, 'sleep', 5) for i in range(0, 10)]
+        gevent.sleep(0.1)
+        self.assertTrue(len(session._requests) == 10)
+        session.abandon()
+        gevent.joinall(calls, timeout=1)
+        self.assertTrue(all(isinstance(c.exception, socket.error) 
+                            for c in calls), 'Requests not failed.')
+        
+    def test_timer_wheel(self):
+        '''Fire timers in time, even after the wheel has been idle.'''
+        import pending
+        wheel = pending.TimerWheel(tick=0.01, slots=8)
+        fired = []
+        wheel.schedule(0.02, fired.append, 1)
+        gevent.sleep(0.5)   # idle for many turns of the wheel
+        self.assertTrue(fired == [1])
+        expire = wheel._expire
+        expired = []
+        def counting_expire(tick):
+            expired.append(tick)
+            expire(tick)
+        wheel._expire = counting_expire
+        wheel.schedule(0.02, fired.append, 2)
+        timer = wheel.schedule(0.02, fired.append, 3)
+        wheel.cancel(timer)
+        gevent.sleep(0.1)
+        self.assertTrue(fired == [1, 2], 'Got %s.' % fired)
+        self.assertTrue(len(expired) < 20, 
+                        'Replayed %d idle ticks.' % len(expired))
+        
+    def test_limiter(self):
+        '''Shed requests over the concurrency limit, and retry them.'''
+        import limiter
+        svr = server.Server(('127.0.0.1', 9990), ServerSession)
+        svr.limiter = limiter.AdaptiveLimiter(initial=4, minimum=4)
+        gevent.spawn(svr.serve_forever)
+        gevent.sleep(0.1)
+        clt = client.Client(('127.0.0.1', 9990))
+        gevent.spawn(clt.serve)
+        # no retry
+        clt.busyRetries = 0
+        calls = [gevent.spawn(clt.call, 'sleep', 0.1) for i in range(0, 20)]
+        gevent.joinall(calls)
+        busy = [c for c in calls if isinstance(c.exception, protocol.Fault)
+                and c.exception.code == protocol.FAULT_SERVER_BUSY[0]]
+        self.assertTrue(len(busy) >= 10 and len(busy) + 
+                        len([c for c in calls if c.value == 0.1]) == 20,
+                        '%s requests shed.' % len(busy))
+        # retry with backoff
+        clt.busyRetries = 10
+        calls = [gevent.spawn(clt.call, 'sleep', 0.1) for i in range(0, 20)]
+        gevent.joinall(calls)
+        self.assertTrue(all(c.value == 0.1 for c in calls), 
+                        'Requests not retried.')
+        self.assertTrue(svr.limiter.inflight == 0)
+        # notifications are shed without a response
+        svr.limiter.limit = 4.0
+        sck = gevent.socket.create_connection(('127.0.0.1', 9990))
+        sck.sendall(b''.join([protocol.Request('sleep', [0.2], rId)
+                              .toJSON().encode('utf-8') + b'\n' 
+                              for rId in (1, 2, 3, 4, None, None, 5)]))
+        fp = sck.makefile('rb')
+        ids = [protocol.parseJson(fp.readline()).id for i in range(0, 5)]
+        self.assertTrue(sorted(ids) == [1, 2, 3, 4, 5], 'Got %s.' % ids)
+        sck.close()
+        clt.disconnect()
+        svr.limiter.stop()
+        svr.stop()
+        
+    def test_result_cache(self):
+        '''Cache results on the client, and invalidate them by server.'''
+        gevent.sleep(0.1)   # let the server start listening
+        ServerSession.settings.update({'a': 1, 'b': 1, 'c': 1})
+        clt = client.Client(('127.0.0.1', 9999))
+        clt.enableCache(maxSize=2)
+        gevent.spawn(clt.serve)
+        cache = clt.session.cache
+        self.assertTrue(clt.call('setting', 'a') == 1)
+        self.assertTrue(clt.call('setting', 'a') == 1)
+        self.assertTrue(cache.hits == 1 and len(cache) == 1)
+        # cached results are copied to the callers
+        ServerSession.settings['list'] = ['x']
+        clt.call('setting', 'list').append('y')
+        clt.call('setting', 'list').append('z')
+        self.assertTrue(clt.call('setting', 'list') == ['x'])
+        self.assertTrue(cache.hits == 3)
+        cache.invalidate('setting', ['list'])
+        self.assertTrue(clt.call('echo', 'x') == 'x' and len(cache) == 1,
+                        'Result not marked as cacheable is cached.')
+        # pushed invalidation
+        ServerSession.settings['a'] = 2
+        self.assertTrue(self.server.invalidate('setting', ['a'], 2) >= 1)
+        gevent.sleep(0.1)
+        self.assertTrue(clt.call('setting', 'a') == 2, 'Not invalidated.')
+        # LRU
+        clt.call('setting', 'b')
+        clt.call('setting', 'c')
+        self.assertTrue(len(cache) == 2 and 
+                        cache.get(cache.key('setting', ('a',)))[0] == False)
+        clt.disconnect()
         
+    def test_tracing(self):
+        '''Propagate trace context through nested calls, record spans.'''
+        import tracing
+        class TracedSession(ServerSession):
+            @protocol.expose
+            def relay(self, message):
+                return self.call('echo', message)
+        server_sink = tracing.CollectorSink(batchSize=1)
+        client_sink = tracing.CollectorSink(batchSize=1)
+        svr = server.Server(('127.0.0.1', 9989), TracedSession)
+        svr.tracer = tracing.Tracer(server_sink, sampleRate=1.0)
+        gevent.spawn(svr.serve_forever)
+        gevent.sleep(0.1)
+        clt = client.Client(('127.0.0.1', 9989))
+        clt.setTracer(tracing.Tracer(client_sink, sampleRate=1.0))
+        gevent.spawn(clt.serve)
+        self.assertTrue(clt.call('relay', 'hi') == 'hi')
+        gevent.sleep(0.1)
+        spans = server_sink.exported + client_sink.exported
+        self.assertTrue(len(set(s['traceId'] for s in spans)) == 1,
+                        'Spans belong to different traces.')
+        byName = {}
+        for s in spans:
+            byName.setdefault(s['name'], []).append(s)
+        # client call -> server phases -> server call -> client phases
+        root = [s for s in byName['call'] if not s['parentSpanId']][0]
+        dispatch = [s for s in byName['dispatch'] 
+                    if s['parentSpanId'] == root['spanId']][0]
+        nested = [s for s in byName['call'] 
+                  if s['parentSpanId'] == dispatch['spanId']][0]
+        for name in ('parse', 'queue', 'dispatch', 'encode', 'write'):
+            self.assertTrue(len(byName[name]) == 2, 'No %s span.' % name)
+            self.assertTrue(set(s['parentSpanId'] for s in byName[name]) ==
+                            set([root['spanId'], nested['spanId']]))
+        # the decision not to sample goes along, down to nested calls
+        del server_sink.exported[:], client_sink.exported[:]
+        clt.session.tracer.sampleRate = 0.0
+        self.assertTrue(clt.call('relay', 'hi') == 'hi')
+        gevent.sleep(0.1)
+        self.assertTrue(server_sink.exported == [] and 
+                        client_sink.exported == [], 'Unsampled trace recorded.')
+        clt.disconnect()
+        svr.stop()
         
+    def test_idle_sessions(self):
+        '''Park idle sessions, and serve them again when they speak.'''
+        svr = server.Server(('127.0.0.1', 9988), ServerSession)
+        svr.idleTimeout = 0.1
+        gevent.spawn(svr.serve_forever)
+        gevent.sleep(0.1)
+        clt = client.Client(('127.0.0.1', 9988))
+        gevent.spawn(clt.serve)
+        self.assertTrue(clt.call('echo', 'hi') == 'hi')
+        gevent.sleep(0.3)
+        self.assertTrue(len(svr._parked) == 1, 'Session not parked.')
+        session = list(svr.clients.keys())[0]
+        self.assertTrue(session._requests is None and session._buf is None,
+                        'Idle session not released.')
+        # woken by a request, and by the response to a call of ours
+        self.assertTrue(clt.call('echo', 'again') == 'again')
+        gevent.sleep(0.3)
+        self.assertTrue(session.call('echo', 'back') == 'back')
+        self.assertTrue(len(svr.clients) == 1)
+        clt.disconnect()
+        gevent.sleep(0.3)
+        self.assertTrue(not svr.clients and not svr._parked,
+                        'Disconnected session not dropped.')
+        svr.stop()
         
     def test_client_echo(self):
         '''
@@ -211,6 +758,153 @@ class Test(unittest.TestCase):
         sys.stdout.flush()
         return
             
+    def test_broadcast_window(self):
+        '''
+        Open a server on port 9996 which gathers broadcasts within 10ms, 
+        let 20 clients broadcast 50 messages each, and check that every 
+        client receives all messages of the others exactly once.
+        '''
+        start_time = time.time()
+        svr = server.Server(('127.0.0.1', 9996), ServerSession)
+        svr.broadcastWindow = 0.01
+        gevent.spawn(svr.serve_forever)
+        gevent.sleep(0.1)
+        class ClientSession(client.ClientSession):
+            def __init__(self, *args, **kwargs):
+                super(ClientSession, self).__init__(*args, **kwargs)
+                self.jar = []
+            @protocol.expose
+            def push(self, n):
+                self.jar.append(n)
+        clients = [client.Client(('127.0.0.1', 9996), ClientSession)
+                   for i in range(0, 20)]
+        for c in clients:
+            gevent.spawn(c.serve)
+        gevent.sleep(0.1)
+        def run_client(k, c):
+            for i in range(0, 50):
+                self.assertTrue(c.broadcast('push', k * 50 + i) == 19,
+                                'Broadcast not sent to all clients.')
+        gevent.joinall([gevent.spawn(run_client, k, c) 
+                        for k, c in enumerate(clients)])
+        gevent.sleep(0.5)
+        for k, c in enumerate(clients):
+            expected = set(range(0, 1000)) - set(range(k * 50, k * 50 + 50))
+            self.assertTrue(len(c.session.jar) == 950 and 
+                            set(c.session.jar) == expected,
+                            'Client %s got %s messages.' 
+                            % (k, len(c.session.jar)))
+            c.disconnect()
+        svr.stop()
+        sys.stdout.write ('\ntest_broadcast_window done in %.3fs' 
+                            % (time.time() - start_time))
+        sys.stdout.flush()
+        
+    def test_gather(self):
+        '''
+        Open a server on port 9994 with 10 clients, one of which answers 
+        slowly, and gather results with deadline and quorum.
+        '''
+        svr = server.Server(('127.0.0.1', 9994), ServerSession)
+        gevent.spawn(svr.serve_forever)
+        gevent.sleep(0.1)
+        class ClientSession(client.ClientSession):
+            delay = 0
+            @protocol.expose
+            def stats(self, n):
+                gevent.sleep(self.delay)
+                return n + 1
+        clients = [client.Client(('127.0.0.1', 9994), ClientSession)
+                   for i in range(0, 10)]
+        clients[0].session.delay = 1
+        for c in clients:
+            gevent.spawn(c.serve)
+        gevent.sleep(0.1)
+        # all results
+        ret = svr.gather('stats', [1])
+        self.assertTrue(len(ret) == 10 and set(ret.values()) == set([2]),
+                        'Gather got %s.' % ret)
+        # partial results at deadline
+        start_time = time.time()
+        ret = svr.gather('stats', [2], deadline=0.3)
+        self.assertTrue(len(ret) == 9 and time.time() - start_time < 0.6,
+                        'Gather with deadline got %s.' % ret)
+        # quorum, and errors as values
+        ret = svr.gather('stats', {'m': 1}, quorum=3)
+        self.assertTrue(len(ret) >= 3 and all(isinstance(v, protocol.Fault)
+                                              for v in ret.values()))
+        ret = svr.gather('stats', [3], quorum=3)
+        self.assertTrue(len(ret) == 3, 'Gather with quorum got %s.' % ret)
+        # selector
+        chosen = list(svr.clients.keys())[0:4]
+        ret = svr.gather('stats', [4], lambda c: c in chosen, 0.3)
+        self.assertTrue(set(ret.keys()) <= set(chosen) and len(ret) >= 3,
+                        'Gather with selector got %s.' % ret)
+        for c in clients:
+            c.disconnect()
+        svr.stop()
+        
+    def test_gateway(self):
+        '''
+        Open two backend servers on port 9993 and 9992, and a gateway on 
+        port 9991 which shards `shard_*` methods over both of them.
+        '''
+        import gateway
+        class BackendSession(server.ServerSession):
+            @protocol.expose
+            def shard_whoami(self, n):
+                return [self.server.server_port, n]
+        backends = [server.Server(('127.0.0.1', p), BackendSession)
+                    for p in (9993, 9992)]
+        addresses = [('127.0.0.1', p) for p in (9993, 9992)]
+        gw = gateway.Gateway(('127.0.0.1', 9991), 
+                             [gateway.Route('shard_', addresses),
+                              gateway.Route('echo', addresses[0:1])])
+        for s in backends + [gw]:
+            gevent.spawn(s.serve_forever)
+        gevent.sleep(0.1)
+        clt = client.Client(('127.0.0.1', 9991))
+        gevent.spawn(clt.serve)
+        # requests are sharded, and results come back untouched
+        ports = set()
+        for i in range(0, 20):
+            port, n = clt.call('shard_whoami', {'x': [i, 'a"]}']})
+            self.assertTrue(n == {'x': [i, 'a"]}']}, 'Gateway got %s.' % n)
+            ports.add(port)
+        self.assertTrue(ports == set([9993, 9992]), 'Not sharded.')
+        self.assertTrue(clt.call('echo', 'hi') == 'hi')
+        self.assertRaises(protocol.Fault, clt.call, 'nothing')
+        # batches are routed message by message, and nothing is served by
+        # the gateway itself
+        sck = gevent.socket.create_connection(('127.0.0.1', 9991))
+        sck.sendall('[{"id":1,"method":"shard_whoami","params":[1]},'
+                    '{"id":2,"method":"echo","params":["café"]},'
+                    '{"id":3,"method":"broadcast","params":[["echo",[]]]},'
+                    '{"id":null,"method":"echo","params":[4]}, 5]\n'
+                    .encode('utf-8'))
+        fp = sck.makefile('rb')
+        got = dict((r.id, r) for r in [protocol.parseJson(fp.readline())
+                                        for i in range(0, 4)])
+        self.assertTrue(got[1].result[1] == 1 and got[2].result == 'café',
+                        'Gateway got %r.' % got)
+        self.assertTrue(got[3].error.code == protocol.PROC_NOT_FOUND.code)
+        self.assertTrue(got[None].error.code 
+                        == protocol.INVALID_JSON_RPC.code)
+        sck.close()
+        # lost backend
+        backends[1].stop()
+        for b in list(gw.backends.values()):
+            b.abandon()
+        gevent.sleep(0.1)
+        self.assertRaises(protocol.Fault, clt.call, 'shard_whoami', 
+                          [i for i in range(0, 20) 
+                           if gw.routes[0].get('shard_whoami[%d]' % i)
+                                    == addresses[1]][0])
+        self.assertTrue(clt.call('echo', 'hi') == 'hi')
+        clt.disconnect()
+        for s in backends + [gw]:
+            s.stop()
+        
 # run
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
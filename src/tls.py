@@ -0,0 +1,308 @@
+# -*- encoding: utf-8 -*-
+# $File: tls.py
+#
+# Copyright (C) 2012 the pynojo development team <see AUTHORS file>
+#
+# This file is part of pynojo
+#
+# pynojo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynojo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynojo.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function, unicode_literals
+import socket, ssl, time, errno, logging
+import gevent, gevent.socket, gevent.threadpool
+
+# TLS with handshakes off the hub
+#
+# The public key operations of a full handshake take milliseconds of CPU
+# each, so handshaking on the hub stalls every other connection during a
+# reconnect storm. Here the handshake runs on a blocking copy of the
+# socket in a thread pool (OpenSSL releases the GIL meanwhile), and the
+# connection is handed back to the hub as a TLSSocket.
+#
+# The pool is a small one of its own by default, so that handshakes never
+# hold up what else runs in the hub's pool, like DNS lookups. Servers
+# wait on the hub for the first bytes of the client before taking a
+# thread, so that silent connections cannot occupy the pool.
+#
+# Servers issue session tickets, and clients remember the session of each
+# server to resume it on reconnection, which skips the public key
+# operations altogether (the latter needs ssl.SSLSession, Python 3.6+).
+#
+
+def server_context(certfile, keyfile=None, cafile=None, verifyClient=False,
+                   ciphers=None):
+    '''
+    Create an SSLContext for servers.
+
+    :param cafile: CA certificates to verify clients with.
+    :param verifyClient: Require clients to present a certificate.
+    :param ciphers: OpenSSL cipher list. None for the default.
+    '''
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= (ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 |
+                        getattr(ssl, 'OP_NO_COMPRESSION', 0))
+    if (ciphers is not None):
+        context.set_ciphers(ciphers)
+    # session tickets are on as long as OP_NO_TICKET is not set
+    context.load_cert_chain(certfile, keyfile)
+    if (cafile is not None):
+        context.load_verify_locations(cafile)
+        context.verify_mode = (ssl.CERT_REQUIRED if verifyClient
+                                                 else ssl.CERT_OPTIONAL)
+    return context
+
+def client_context(cafile=None, certfile=None, keyfile=None, verify=True,
+                   ciphers=None):
+    '''
+    Create an SSLContext for clients.
+
+    :param cafile: CA certificates to verify servers with. None to use
+        the default ones.
+    :param verify: Verify the certificate of servers, and their host
+        name, which must then be given to handshake.
+    :param ciphers: OpenSSL cipher list. None for the default.
+    '''
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= (ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 |
+                        getattr(ssl, 'OP_NO_COMPRESSION', 0))
+    if (ciphers is not None):
+        context.set_ciphers(ciphers)
+    if (certfile is not None):
+        context.load_cert_chain(certfile, keyfile)
+    if (verify):
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.check_hostname = True
+        if (cafile is not None):
+            context.load_verify_locations(cafile)
+        else:
+            context.load_default_certs()
+    return context
+
+class HandshakeStats(object):
+    '''Count and time handshakes, by outcome.'''
+    KINDS = ('full', 'resumed', 'failed', 'shed')
+
+    def __init__(self):
+        self.counts = dict((k, 0) for k in self.KINDS)
+        self.seconds = dict((k, 0.0) for k in self.KINDS)
+        self.slowest = 0.0
+
+    def record(self, kind, seconds=0.0):
+        self.counts[kind] += 1
+        self.seconds[kind] += seconds
+        self.slowest = max(self.slowest, seconds)
+
+    def average(self, kind):
+        '''Average seconds of handshakes of the kind.'''
+        count = self.counts[kind]
+        return self.seconds[kind] / count if count else 0.0
+
+class RateLimit(object):
+    '''Token bucket admitting handshakes at a steady rate.'''
+    def __init__(self, rate, burst=None):
+        '''
+        Create a rate limit.
+
+        :param rate: Handshakes per second.
+        :type rate: float.
+
+        :param burst: Handshakes admitted at once after a quiet period.
+            None for one second worth of handshakes.
+        :type burst: int.
+        '''
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._last = time.time()
+
+    def acquire(self):
+        '''
+        Try to admit a handshake.
+
+        :return: False if the connection should be dropped.
+        '''
+        now = time.time()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if (self._tokens < 1):
+            return False
+        self._tokens -= 1
+        return True
+
+class TLSSocket(object):
+    '''
+    Cooperative socket over an SSL socket which has done its handshake.
+
+    It provides what Session uses of a socket.
+    '''
+    def __init__(self, sslSocket):
+        sslSocket.setblocking(False)
+        self._sck = sslSocket
+
+    def fileno(self):
+        return self._sck.fileno()
+
+    def getpeername(self):
+        return self._sck.getpeername()
+
+    def getsockname(self):
+        return self._sck.getsockname()
+
+    def getpeercert(self, binary_form=False):
+        return self._sck.getpeercert(binary_form)
+
+    def pending(self):
+        return self._sck.pending()
+
+    def recv(self, size):
+        while True:
+            try:
+                return self._sck.recv(size)
+            except ssl.SSLWantReadError:
+                gevent.socket.wait_read(self._sck.fileno())
+            except ssl.SSLWantWriteError:
+                gevent.socket.wait_write(self._sck.fileno())
+            except socket.error as e:
+                if (e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK)):
+                    raise
+                gevent.socket.wait_read(self._sck.fileno())
+
+    def sendall(self, data):
+        offset = 0
+        while offset < len(data):
+            try:
+                sent = self._sck.send(data[offset:])
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                sent = 0
+            except socket.error as e:
+                if (e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK)):
+                    raise
+                sent = 0
+            if (not sent):
+                gevent.socket.wait_write(self._sck.fileno())
+            offset += sent
+
+    def close(self):
+        self._sck.close()
+
+_sessions = {}      # session key -> ssl.SSLSession
+_pool = None
+
+def default_pool():
+    '''Get the thread pool shared by handshakes.'''
+    global _pool
+    if (_pool is None):
+        _pool = gevent.threadpool.ThreadPool(4)
+    return _pool
+
+def _handshake(sck, context, serverSide, serverHostname, session, timeout):
+    '''
+    Do the handshake on a blocking socket. Run in a thread.
+
+    Errors are returned rather than raised, as the thread pool would
+    print them as unhandled.
+    '''
+    start = time.time()
+    sck.settimeout(timeout)
+    kwargs = {'server_side': serverSide, 'do_handshake_on_connect': False}
+    if (serverHostname is not None):
+        kwargs['server_hostname'] = serverHostname
+    if (session is not None):
+        kwargs['session'] = session
+    try:
+        sslSocket = context.wrap_socket(sck, **kwargs)
+        sslSocket.do_handshake()
+    except (ssl.SSLError, socket.error) as e:
+        sck.close()
+        return (e, time.time() - start)
+    return (sslSocket, time.time() - start)
+
+def handshake(sck, context, serverSide=False, serverHostname=None,
+              sessionKey=None, stats=None, pool=None, timeout=10, wait=1.0):
+    '''
+    Do the TLS handshake of a connected socket in a thread pool.
+
+    The socket given is closed, and the connection goes on as the
+    TLSSocket returned. Raise ssl.SSLError or socket.error on failure.
+
+    :param sck: Connected socket.
+    :type sck: gevent.socket.socket.
+
+    :param context: TLS configuration.
+    :type context: ssl.SSLContext.
+
+    :param sessionKey: Client side only. Remember the session under this
+        key, and try to resume it next time.
+
+    :param stats: Where to record the handshake.
+    :type stats: HandshakeStats.
+
+    :param serverHostname: Client side only. Host name to check the
+        certificate of the server against. Required if the context checks
+        host names.
+
+    :param pool: Thread pool to run the handshake. None to use
+        default_pool().
+    :type pool: gevent.threadpool.ThreadPool.
+
+    :param timeout: Seconds the handshake may take.
+    :type timeout: float.
+
+    :param wait: Server side only. Seconds to wait for the client to
+        start the handshake, before a thread is taken for it.
+    :type wait: float.
+    '''
+    if (not serverSide and serverHostname is None and
+            getattr(context, 'check_hostname', False)):
+        sck.close()
+        raise ValueError('The host name of the server is required to '
+                         'check its certificate.')
+    if (serverSide):
+        start = time.time()
+        try:
+            gevent.socket.wait_read(sck.fileno(), wait)
+        except socket.timeout:
+            sck.close()
+            if (stats is not None):
+                stats.record('failed', time.time() - start)
+            raise
+    blocking = socket.fromfd(sck.fileno(), sck.family, sck.type)
+    if (not isinstance(blocking, socket.socket)):
+        blocking = socket.socket(_sock=blocking)    # Python 2
+    sck.close()
+    session = None
+    if (sessionKey is not None and hasattr(ssl, 'SSLSession')):
+        session = _sessions.get(sessionKey, None)
+    if (pool is None):
+        pool = default_pool()
+    sslSocket, elapsed = pool.apply(_handshake, (
+            blocking, context, serverSide, serverHostname, session, timeout))
+    if (isinstance(sslSocket, Exception)):
+        if (stats is not None):
+            stats.record('failed', elapsed)
+        raise sslSocket
+    if (sessionKey is not None and hasattr(ssl, 'SSLSession')):
+        _sessions[sessionKey] = sslSocket.session
+    resumed = getattr(sslSocket, 'session_reused', False)
+    if (stats is not None):
+        stats.record('resumed' if resumed else 'full', elapsed)
+    logging.debug('TLS handshake with %s in %.3fs%s.' % (
+            ':'.join(str(s) for s in sslSocket.getpeername()[:2]),
+            elapsed, ' (resumed)' if resumed else ''))
+    return TLSSocket(sslSocket)
+
+# Handshakes made by clients
+clientStats = HandshakeStats()
@@ -0,0 +1,172 @@
+# -*- encoding: utf-8 -*-
+# $File: tracing.py
+#
+# Copyright (C) 2012 the pynojo development team <see AUTHORS file>
+#
+# This file is part of pynojo
+#
+# pynojo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynojo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynojo.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function, unicode_literals
+import random, threading, logging
+import gevent.local
+
+import protocol
+
+# Distributed tracing
+#
+# A traced request carries a non-standard "trace" member:
+#
+#     {"trace_id": "<32 hex>", "span_id": "<16 hex>", "sampled": true}
+#
+# where span_id is the span of the caller. If the trace is sampled, the
+# serving side records the spans of its phases as children of it:
+#
+# - parse: mapping the shared memory segment, if any, and parsing the 
+#   message, after its line has been read;
+# - queue: waiting for the greenlet to start;
+# - dispatch: running the RPC method;
+# - encode: encoding the response;
+# - write: sending the response.
+#
+# While the method runs, its dispatch span is the current context of the
+# greenlet, so that calls it makes are traced as its children. Whether
+# a trace is recorded is decided once, where it starts, and the decision
+# travels with the context: calls of a trace which is not sampled carry 
+# it too, so that no side further down starts a trace of its own. A
+# context without the flag comes from an older peer, which sent it only
+# when sampled.
+#
+# Spans use the field names of OpenTelemetry (OTLP JSON), so that a sink
+# can hand them to a collector as they are.
+#
+
+def new_trace_id():
+    return '%032x' % random.getrandbits(128)
+
+def new_span_id():
+    return '%016x' % random.getrandbits(64)
+
+_local = gevent.local.local()
+
+def current():
+    '''Get the trace context of the current greenlet, or None.'''
+    return getattr(_local, 'context', None)
+
+def is_sampled(context):
+    '''Check whether the spans of the context are to be recorded.'''
+    return context.get('sampled', True)
+
+def set_current(context):
+    '''Set the trace context of the current greenlet.'''
+    _local.context = context
+
+class Tracer(object):
+    '''Sample traces and export their spans to a sink.'''
+    def __init__(self, sink, sampleRate=0.01, service='json-socket-rpc'):
+        '''
+        Create a tracer.
+
+        :param sink: Where spans go.
+        :type sink: Object with an export(span) method.
+
+        :param sampleRate: Fraction of new traces to record.
+        :type sampleRate: float.
+        '''
+        self.sink = sink
+        self.sampleRate = sampleRate
+        self.service = service
+
+    def sample(self):
+        '''
+        Start a new trace, and decide whether to record it.
+
+        :return: Root context.
+        '''
+        return {'trace_id': new_trace_id(), 'span_id': None,
+                'sampled': random.random() < self.sampleRate}
+
+    def record(self, context, name, start, end, spanId=None, **attrs):
+        '''
+        Record a span under the context.
+
+        :param context: Parent context.
+        :param start: Start time in seconds since epoch.
+        :param end: End time in seconds since epoch.
+        :param spanId: Id of the span. None to make one.
+        :return: Id of the span.
+        '''
+        if (spanId is None):
+            spanId = new_span_id()
+        attrs['service.name'] = self.service
+        span = {'traceId': context['trace_id'], 'spanId': spanId,
+                'parentSpanId': context.get('span_id', None) or '',
+                'name': name,
+                'startTimeUnixNano': int(start * 1e9),
+                'endTimeUnixNano': int(end * 1e9),
+                'attributes': [{'key': k, 'value': {'stringValue': '%s' % v}}
+                               for k, v in sorted(attrs.items())]}
+        try:
+            self.sink.export(span)
+        except Exception:
+            logging.exception('Cannot export span.')
+        return spanId
+
+class FileSink(object):
+    '''Append spans to a local file, one JSON object per line.'''
+    def __init__(self, path):
+        self._fp = open(path, 'ab')
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        s = protocol.json_encode(span)
+        if (not isinstance(s, bytes)):
+            s = s.encode('utf-8')
+        with self._lock:
+            self._fp.write(s + b'\n')
+            self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+class CollectorSink(object):
+    '''
+    Hand spans to a collector in batches.
+
+    The send callable gets an OTLP JSON style export request, e.g. to
+    post it to the /v1/traces endpoint of a collector. Without one, the
+    batches are kept in memory, which is useful as a stand-in in tests.
+    '''
+    def __init__(self, send=None, batchSize=64):
+        self.send = send
+        self.batchSize = batchSize
+        self.exported = []
+        self._spans = []
+
+    def export(self, span):
+        self._spans.append(span)
+        if (len(self._spans) >= self.batchSize):
+            self.flush()
+
+    def flush(self):
+        '''Send the spans buffered.'''
+        spans, self._spans = self._spans, []
+        if (not spans):
+            return
+        request = {'resourceSpans': [{'scopeSpans': [{'spans': spans}]}]}
+        if (self.send is None):
+            self.exported.extend(spans)
+        else:
+            self.send(request)